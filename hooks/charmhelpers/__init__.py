@@ -28,11 +28,25 @@ except ImportError:
         subprocess.check_call(['apt-get', 'install', '-y', 'python3-six'])
     import six  # flake8: noqa
 
-try:
-    import yaml  # flake8: noqa
-except ImportError:
+
+def _importable(name):
+    """True if module name can be imported, without importing it."""
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+    return find_spec(name) is not None
+
+
+# yaml is slow to import and most hooks never need it, so only check that
+# it is there.
+if not _importable('yaml'):
     if sys.version_info.major == 2:
         subprocess.check_call(['apt-get', 'install', '-y', 'python-yaml'])
     else:
         subprocess.check_call(['apt-get', 'install', '-y', 'python3-yaml'])
-    import yaml  # flake8: noqa
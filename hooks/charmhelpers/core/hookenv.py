@@ -21,13 +21,12 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import atexit as _py_atexit
 import copy
-from distutils.version import LooseVersion
 from functools import wraps
 import glob
 import os
 import json
-import yaml
 import subprocess
 import sys
 import errno
@@ -47,7 +46,36 @@ INFO = "INFO"
 DEBUG = "DEBUG"
 MARKER = object()
 
-cache = {}
+class Cache(dict):
+    """Return values of @cached functions.
+
+    Entries are keyed by (func, args, kwargs) tuples and indexed by function
+    name and by every string argument (unit names, relation ids, ...), so
+    flush() is an index lookup instead of a scan over every key. hits and
+    misses count lookups since the cache was created.
+    """
+
+    def __init__(self):
+        super(Cache, self).__init__()
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key, tokens, value):
+        self[key] = value
+        for token in tokens:
+            self.index.setdefault(token, set()).add(key)
+
+    def flush(self, token):
+        for key in self.index.pop(token, ()):
+            self.pop(key, None)
+
+    def clear(self):
+        super(Cache, self).clear()
+        self.index.clear()
+
+
+cache = Cache()
 
 
 def cached(func):
@@ -65,37 +93,49 @@ def cached(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key = (func, args, tuple(sorted(kwargs.items())))
         try:
-            return cache[key]
+            hash(key)
+        except TypeError:
+            key = str((func, args, kwargs))
+        try:
+            res = cache[key]
         except KeyError:
             pass  # Drop out of the exception handler scope.
+        else:
+            cache.hits += 1
+            return res
+        cache.misses += 1
         res = func(*args, **kwargs)
-        cache[key] = res
+        tokens = [func.__name__]
+        tokens.extend(arg for arg in args + tuple(kwargs.values())
+                      if isinstance(arg, six.string_types))
+        cache.add(key, tokens, res)
         return res
     wrapper._wrapped = func
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache where key is the
+    function name or one of its string arguments"""
+    cache.flush(key)
 
 
 def log(message, level=None):
     """Write a message to the juju log"""
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    if _log_buffer is not None:
+        _log_buffer.add(message, level)
+    else:
+        _juju_log(message, level)
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
     command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
@@ -111,6 +151,61 @@ def log(message, level=None):
             raise
 
 
+LOG_BUFFER_SIZE = 16 * 1024
+
+
+class LogBuffer(object):
+    """Coalesces log() messages into one juju-log call per batch.
+
+    Buffered messages are written when a message of another level comes in,
+    when max_size bytes are buffered and on flush().
+    """
+
+    def __init__(self, max_size=LOG_BUFFER_SIZE):
+        self.max_size = max_size
+        self.level = None
+        self.lines = []
+        self.size = 0
+
+    def add(self, message, level=None):
+        if self.lines and level != self.level:
+            self.flush()
+        self.level = level
+        self.lines.append(message)
+        self.size += len(message)
+        if self.size >= self.max_size:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        message = '\n'.join(self.lines)
+        level = self.level
+        self.lines = []
+        self.size = 0
+        _juju_log(message, level)
+
+
+_log_buffer = None
+
+
+def buffer_logs(max_size=LOG_BUFFER_SIZE):
+    """Buffer log() output in a LogBuffer instead of running juju-log for
+    every message. Whatever is buffered is written when the process exits,
+    whether or not the hook succeeded.
+    """
+    global _log_buffer
+    if _log_buffer is None:
+        _log_buffer = LogBuffer(max_size)
+        _py_atexit.register(flush_logs)
+
+
+def flush_logs():
+    """Write out messages buffered by buffer_logs()."""
+    if _log_buffer is not None:
+        _log_buffer.flush()
+
+
 class Serializable(UserDict):
     """Wrapper, an object that can be serialized to yaml or json"""
 
@@ -147,6 +242,7 @@ class Serializable(UserDict):
 
     def yaml(self):
         """Serialize the object to yaml"""
+        import yaml
         return yaml.dump(self.data)
 
 
@@ -385,6 +481,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # available, since otherwise we'll break if the relation data is
         # too big. Ideally we should tell relation-set to read the data from
         # stdin, but that feature is broken in 1.23.2: Bug #1454678.
+        import yaml
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
         subprocess.check_call(
@@ -474,6 +571,7 @@ def relations_of_type(reltype=None):
 @cached
 def metadata():
     """Get the current charm metadata.yaml contents as a python object"""
+    import yaml
     with open(os.path.join(charm_dir(), 'metadata.yaml')) as md:
         return yaml.safe_load(md)
 
@@ -942,6 +1040,8 @@ def juju_version():
 @cached
 def has_juju_version(minimum_version):
     """Return True if the Juju version is at least the provided version"""
+    # imported here, distutils is slow to import and rarely needed
+    from distutils.version import LooseVersion
     return LooseVersion(juju_version()) >= LooseVersion(minimum_version)
 
 
@@ -32,6 +32,7 @@ import subprocess
 import hashlib
 import functools
 import itertools
+import time
 from contextlib import contextmanager
 from collections import OrderedDict
 
@@ -374,19 +375,48 @@ def fstab_mount(mountpoint):
     return True
 
 
+HASH_CHUNK_SIZE = 64 * 1024
+# Files modified this recently are not cached, as a change within the
+# timestamp granularity of the filesystem would not show in their stat.
+HASH_CACHE_MIN_AGE = 2
+# {(path, hash_type): (stat key, hex digest)}
+_hash_cache = {}
+
+
+def _stat_key(st):
+    return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime),
+            getattr(st, 'st_ctime_ns', st.st_ctime), st.st_ino)
+
+
 def file_hash(path, hash_type='md5'):
     """Generate a hash checksum of the contents of 'path' or None if not found.
 
+    The file is read in chunks, and its checksum is remembered along with
+    its size, timestamps and inode so that an unchanged file is not read
+    again.
+
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
     """
-    if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
-    else:
+    try:
+        st = os.stat(path)
+    except OSError:
         return None
+    key = _stat_key(st)
+    cached = _hash_cache.get((path, hash_type))
+    if cached and cached[0] == key:
+        return cached[1]
+
+    h = getattr(hashlib, hash_type)()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    if time.time() - max(st.st_mtime, st.st_ctime) > HASH_CACHE_MIN_AGE:
+        _hash_cache[(path, hash_type)] = (key, digest)
+    else:
+        _hash_cache.pop((path, hash_type), None)
+    return digest
 
 
 def path_hash(path):
@@ -1,6 +1,20 @@
+import errno
+import fcntl
+import json
 import os
+import time
 
-from charmhelpers.core.hookenv import log, INFO
+from charmhelpers.core.hookenv import log, ERROR, INFO
+from cihelpers import metrics
+
+# After a run, a job is skipped until it has been idle for this fraction of
+# the last run's duration, so jobs that outgrow their schedule back off
+# instead of running back to back.
+COOLDOWN_RATIO = 0.5
+# A run still holding the lock after this many times the last run's
+# duration, and at least STUCK_MIN_SECONDS, is reported as stuck.
+STUCK_RATIO = 4
+STUCK_MIN_SECONDS = 60 * 60
 
 
 def write_cronjob(content, job_name=''):
@@ -50,3 +64,97 @@ def schedule_repo_updates(schedule, ci_user, ci_config_dir, conf_repo_rcs,
 def schedule_generic_job(schedule, user, name, job):
     content = "%s %s %s\n" % (schedule, user, job)
     write_cronjob(content, job_name=name)
+
+
+class RunCoordinator(object):
+    """Single-flight runs for cron jobs.
+
+    A run takes an exclusive lock on lock_path; when a previous run still
+    holds it, the new run is skipped rather than queued behind it. Start,
+    end, duration and outcome of the last run are kept next to the lock and
+    used to skip runs during the cooldown that follows a long run, and to
+    report a run that holds the lock far longer than the last one took.
+    """
+
+    def __init__(self, lock_path, cooldown_ratio=COOLDOWN_RATIO, name=None):
+        self.lock_path = lock_path
+        self.state_path = lock_path + '.state'
+        self.cooldown_ratio = cooldown_ratio
+        self.name = name or os.path.basename(lock_path)
+
+    def state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.state_path)
+
+    def cooldown(self, now=None):
+        """Seconds left before the next run is allowed."""
+        state = self.state()
+        if 'last_end' not in state:
+            return 0
+        now = now or time.time()
+        idle = now - state['last_end']
+        return max(0, state['last_duration'] * self.cooldown_ratio - idle)
+
+    def stuck(self, now=None):
+        """Seconds the run in progress has been going for if it looks stuck,
+        otherwise 0."""
+        state = self.state()
+        if state.get('status') != 'running':
+            return 0
+        running = (now or time.time()) - state['last_start']
+        limit = max(STUCK_MIN_SECONDS,
+                    state.get('last_duration', 0) * STUCK_RATIO)
+        return running if running > limit else 0
+
+    def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) unless another run is in progress or
+        the cooldown has not passed yet.
+
+        A run is recorded as failed if func raises or returns a non zero
+        exit status.
+
+        :returns: (True, result of func) or (False, reason it was skipped)
+        """
+        with open(self.lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                running = self.stuck()
+                if running:
+                    log('%s: previous run has held %s for %d seconds, it may '
+                        'be hung.' % (self.name, self.lock_path, running),
+                        ERROR)
+                    metrics.inc('ci_configurator_cron_stuck_total',
+                                job=self.name)
+                return False, 'previous run still in progress'
+
+            wait = self.cooldown()
+            if wait:
+                return False, 'cooling down for %d more seconds' % wait
+
+            state = self.state()
+            state.update(last_start=time.time(), status='running')
+            self._save_state(state)
+            status = 'failed'
+            try:
+                result = func(*args, **kwargs)
+                if not result:
+                    status = 'ok'
+                return True, result
+            finally:
+                end = time.time()
+                state.update(last_end=end,
+                             last_duration=end - state['last_start'],
+                             status=status)
+                self._save_state(state)
@@ -3,24 +3,22 @@ import os
 import sys
 import subprocess
 import json
+import time
 
 from charmhelpers.core.hookenv import (
     log as _log,
     ERROR,
 )
-try:
-    import paramiko
-except ImportError:
-    if sys.version_info.major == 2:
-        subprocess.check_call(['apt-get', 'install', '-y', 'python-paramiko'])
-    else:
-        subprocess.check_call(['apt-get', 'install', '-y', 'python3-paramiko'])
-    import paramiko
+from cihelpers import metrics, profiling
 
 _connection = None
+_paramiko = None
 GERRIT_DAEMON = "/etc/init.d/gerrit"
-
-logging.basicConfig(level=logging.INFO)
+# number of users whose account ids, ssh keys and OpenIDs are read and
+# written with a single gsql statement.
+GSQL_BATCH_SIZE = 100
+# caches holding account data that direct gsql writes leave stale.
+ACCOUNT_CACHES = ('accounts', 'accounts_byemail', 'accounts_byname', 'sshkeys')
 
 
 def log(msg, level=None):
@@ -33,11 +31,43 @@ def log(msg, level=None):
         logging.info(msg)
 
 
+def _sql_quote(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def _sql_list(values):
+    return ', '.join(_sql_quote(value) for value in values)
+
+
+def _sql_ids(account_ids):
+    return ', '.join(str(int(account_id)) for account_id in account_ids)
+
+
+def _import_paramiko():
+    """paramiko is only imported, and installed if missing, once a gerrit
+    connection is needed; most hooks never talk to gerrit."""
+    global _paramiko
+    if _paramiko is None:
+        try:
+            import paramiko
+        except ImportError:
+            if sys.version_info.major == 2:
+                subprocess.check_call(['apt-get', 'install', '-y',
+                                       'python-paramiko'])
+            else:
+                subprocess.check_call(['apt-get', 'install', '-y',
+                                       'python3-paramiko'])
+            import paramiko
+        _paramiko = paramiko
+    return _paramiko
+
+
 def get_ssh(host, user, port, key_file):
     global _connection
     if _connection:
         return _connection
 
+    paramiko = _import_paramiko()
     _connection = paramiko.SSHClient()
     _connection.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     _connection.connect(host, username=user, port=port, key_filename=key_file)
@@ -67,13 +97,69 @@ class GerritException(Exception):
         super(GerritException, self).__init__(msg)
 
 
+class AccountIdCache(object):
+    """Map of login -> gerrit account id.
+
+    Lookups are served from memory for the rest of the run and, when a
+    path is given, saved there as json so later runs do not have to query
+    account_external_ids again for logins they already know. Ids are
+    trusted for MAX_AGE seconds after they were last checked against
+    gerrit.
+    """
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, path=None):
+        self.path = path
+        self._ids = None
+
+    def _load(self):
+        if self._ids is None:
+            self._ids = {}
+            if self.path and os.path.isfile(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        self._ids = json.load(f)
+                except ValueError:
+                    log('Ignoring corrupt account id cache %s' % self.path)
+        return self._ids
+
+    def get(self, login):
+        entry = self._load().get(login)
+        return entry[0] if entry else None
+
+    def expired(self, login):
+        entry = self._load().get(login)
+        return not entry or time.time() - entry[1] > self.MAX_AGE
+
+    def update(self, account_ids):
+        now = time.time()
+        entries = dict((login, [account_id, now])
+                       for login, account_id in account_ids.items())
+        self._load().update(entries)
+
+    def invalidate(self, logins):
+        ids = self._load()
+        for login in logins:
+            ids.pop(login, None)
+
+    def save(self):
+        if self.path and self._ids is not None:
+            tmp = '%s.tmp' % self.path
+            with open(tmp, 'w') as f:
+                json.dump(self._ids, f)
+            os.rename(tmp, self.path)
+
+
 class GerritClient(object):
-    def __init__(self, host, user, port, key_file):
+    def __init__(self, host, user, port, key_file, account_ids=None):
         self.ssh = get_ssh(host, user, port, key_file)
+        self.account_ids = account_ids or AccountIdCache()
 
     def _run_cmd(self, cmd):
-        stdin, stdout, stderr = self.ssh.exec_command(cmd)
-        return (stdout.read(), stderr.read())
+        with profiling.span('ssh: %s' % cmd[:80]):
+            stdin, stdout, stderr = self.ssh.exec_command(cmd)
+            return (stdout.read().decode('utf-8'),
+                    stderr.read().decode('utf-8'))
 
     def create_user(self, user, name, group, ssh_key):
         log('Creating gerrit new user %s in group %s.' % (user, group))
@@ -90,118 +176,259 @@ class GerritClient(object):
                 log('Error creating account', ERROR)
                 sys.exit(1)
             else:
-                # retrieve user id and update keys
-                account_id = None
-                cmd = ('gerrit gsql --format json -c "SELECT account_id '
-                    'FROM account_external_ids WHERE external_id=\'username:%s\'"'
-                    % (user))
-                stdout, stderr = self._run_cmd(cmd)
-                if not stderr:
-                    # load and decode json, extract account id
-                    lines = stdout.splitlines()
-                    if len(lines)>0:
-                        res = json.loads(lines[0])
-                        try:
-                            account_id = res['columns']['account_id']
-                        except:
-                            pass
-
-                # if found, update ssh keys
+                # retrieve user id and replace keys
+                account_id = self._get_account_ids([user]).get(user)
                 if account_id:
-                    cmd = ('gerrit gsql -c "DELETE FROM account_ssh_keys '
-                           'WHERE account_id=%s' % account_id)
-                    stdout, stderr = self._run_cmd(cmd)
-
-                    # insert new key
-                    cmd = ('gerrit gsql -c "INSERT INTO account_ssh_keys '
-                        '(ssh_public_key, valid, account_id, seq) VALUES (\'%s\', \'Y\', '
-                        '\'%s\', 0)" ' % (ssh_key, account_id))
-                    stdout, stderr = self._run_cmd(cmd)
-
-        # reboot gerrit to refresh accounts
-        stop_gerrit()
-        start_gerrit()
-
-    def create_users_batch(self, group, users):
-        for user in users:
-            # sets container user, name, ssh, openid
-            login = user[0]
-            name = user[1]
-            email = user[2]
-            ssh = user[3]
-            openid = user[4]
-
+                    try:
+                        self._update_ssh_keys({account_id: [ssh_key]})
+                    except GerritException:
+                        self.account_ids.invalidate([user])
+                        raise
+                    self.account_ids.save()
+
+        # refresh accounts without restarting the review site
+        self.flush_cache(ACCOUNT_CACHES)
+
+    def _gsql(self, query):
+        """Run a gsql statement, raising GerritException on failure."""
+        stdout, stderr = self._run_cmd('gerrit gsql -c "%s"' % query)
+        if stderr:
+            raise GerritException(stderr)
+        return stdout
+
+    def _gsql_query(self, query):
+        """Run a gsql SELECT and return its rows as a list of dicts."""
+        stdout, stderr = self._run_cmd('gerrit gsql --format json -c "%s"' %
+                                       query)
+        if stderr:
+            raise GerritException(stderr)
+        rows = []
+        for line in stdout.splitlines():
+            res = json.loads(line)
+            if res.get('type') == 'row':
+                rows.append(res['columns'])
+            elif res.get('type') == 'error':
+                raise GerritException(res.get('message', line))
+        return rows
+
+    def _get_account_ids(self, logins):
+        """Resolve account ids for logins.
+
+        Gerrit is only queried if some login is missing from the account id
+        cache or was last checked more than AccountIdCache.MAX_AGE ago. The
+        query then covers the cached logins too, and cached ids of accounts
+        that were deleted or merged are dropped or replaced.
+
+        Returns a dict of login -> account id for the logins that exist.
+        """
+        cached = {}
+        for login in logins:
+            account_id = self.account_ids.get(login)
+            if account_id:
+                cached[login] = account_id
+        if len(cached) == len(set(logins)) and \
+                not any(self.account_ids.expired(login) for login in cached):
+            return cached
+
+        found = self._query_account_ids(logins)
+        stale = [login for login in cached
+                 if found.get(login) != cached[login]]
+        if stale:
+            log('Cached account ids of %s no longer match gerrit, dropping '
+                'them.' % ', '.join(sorted(stale)))
+            self.account_ids.invalidate(stale)
+        self.account_ids.update(found)
+        return found
+
+    def _query_account_ids(self, logins):
+        """Resolve account ids for logins with a single query."""
+        if not logins:
+            return {}
+        external_ids = dict(('username:%s' % login, login)
+                            for login in logins)
+        rows = self._gsql_query(
+            'SELECT account_id, external_id FROM account_external_ids '
+            'WHERE external_id IN (%s)' % _sql_list(external_ids))
+        return dict((external_ids[row['external_id']],
+                     str(row['account_id'])) for row in rows)
+
+    def _update_ssh_keys(self, keys):
+        """Make each account's ssh keys match the given ones.
+
+        :param keys: dict of account id -> list of ssh public keys
+        :returns: True if any key was added or removed
+        """
+        rows = self._gsql_query(
+            'SELECT account_id, ssh_public_key, seq FROM account_ssh_keys '
+            'WHERE account_id IN (%s)' % _sql_ids(keys))
+        existing = {}
+        for row in rows:
+            existing.setdefault(str(row['account_id']), {})[
+                row['ssh_public_key']] = int(row['seq'])
+
+        stale = []
+        inserts = []
+        for account_id, ssh_keys in keys.items():
+            current = existing.get(account_id, {})
+            seqs = [seq for key, seq in current.items()
+                    if key not in ssh_keys]
+            if seqs:
+                stale.append('(account_id=%d AND seq IN (%s))' %
+                             (int(account_id),
+                              ', '.join(str(seq) for seq in seqs)))
+            seq = max(current.values() or [0])
+            for ssh_key in ssh_keys:
+                if ssh_key in current:
+                    continue
+                seq += 1
+                current[ssh_key] = seq
+                inserts.append('(%s, \'Y\', %d, %d)' %
+                               (_sql_quote(ssh_key), int(account_id), seq))
+
+        if stale:
+            self._gsql('DELETE FROM account_ssh_keys WHERE %s' %
+                       ' OR '.join(stale))
+        if inserts:
+            self._gsql('INSERT INTO account_ssh_keys '
+                       '(ssh_public_key, valid, account_id, seq) VALUES %s' %
+                       ', '.join(inserts))
+        return bool(stale or inserts)
+
+    def _update_openids(self, openids):
+        """Make each account's OpenID external id match the given one.
+
+        :param openids: dict of account id -> (email, openid)
+        :returns: True if any external id was added or removed
+        """
+        wanted = [openid for _, openid in openids.values()]
+        rows = self._gsql_query(
+            'SELECT account_id, external_id FROM account_external_ids '
+            'WHERE external_id LIKE \'http%%\' AND (account_id IN (%s) OR '
+            'external_id IN (%s))' % (_sql_ids(openids), _sql_list(wanted)))
+        owners = {}
+        existing = {}
+        for row in rows:
+            account_id = str(row['account_id'])
+            owners[row['external_id']] = account_id
+            existing.setdefault(account_id, set()).add(row['external_id'])
+
+        stale = []
+        inserts = []
+        for account_id, (email, openid) in openids.items():
+            stale.extend(external_id
+                         for external_id in existing.get(account_id, ())
+                         if external_id != openid)
+            owner = owners.get(openid)
+            if owner == account_id:
+                continue
+            if owner:
+                log('OpenID %s already belongs to account %s, not adding it '
+                    'to account %s.' % (openid, owner, account_id))
+                continue
+            inserts.append('(%d, %s, %s)' % (int(account_id),
+                                             _sql_quote(email),
+                                             _sql_quote(openid)))
+
+        if stale:
+            self._gsql('DELETE FROM account_external_ids WHERE account_id IN '
+                       '(%s) AND external_id IN (%s)' %
+                       (_sql_ids(openids), _sql_list(stale)))
+        if inserts:
+            self._gsql('INSERT INTO account_external_ids '
+                       '(account_id, email_address, external_id) VALUES %s' %
+                       ', '.join(inserts))
+        return bool(stale or inserts)
+
+    def create_users_batch(self, group, users, flush=True):
+        """Create or update users from (login, name, email, ssh_keys, openid)
+        tuples and make them members of group.
+
+        Users are handled GSQL_BATCH_SIZE at a time: account ids, ssh keys
+        and OpenIDs are each read and written with one statement per batch
+        instead of several statements per user. Account caches are flushed
+        once at the end if anything changed, unless flush is False in which
+        case the caller is expected to flush ACCOUNT_CACHES itself when
+        changed is True.
+
+        :returns: (changed, failed) where changed is True if any account was
+                  created or changed and failed lists the logins that could
+                  not be created or updated.
+        """
+        changed = False
+        failed = []
+        try:
+            for i in range(0, len(users), GSQL_BATCH_SIZE):
+                chunk_changed, chunk_failed = self._create_users_chunk(
+                    group, users[i:i + GSQL_BATCH_SIZE])
+                changed = changed or chunk_changed
+                failed.extend(chunk_failed)
+        finally:
+            if changed and flush:
+                self.flush_cache(ACCOUNT_CACHES)
+        return changed, failed
+
+    def _create_users_chunk(self, group, users):
+        logins = [user[0] for user in users]
+        try:
+            return self._apply_users_chunk(group, users, logins)
+        except GerritException:
+            # a cached id may be what made the batch fail, so look them up
+            # again next time.
+            self.account_ids.invalidate(logins)
+            raise
+        finally:
+            self.account_ids.save()
+
+    def _apply_users_chunk(self, group, users, logins):
+        account_ids = self._get_account_ids(logins)
+        # create-account only sets the group of new accounts
+        self.add_group_members(group, [login for login in logins
+                                       if login in account_ids])
+
+        created = []
+        failed = []
+        for login, name, email, _, _ in users:
+            if login in account_ids:
+                continue
             cmd = ('gerrit create-account %s --full-name "%s" '
                    '--group "%s" --email "%s"' %
                    (login, name, group, email))
             stdout, stderr = self._run_cmd(cmd)
 
-            if stderr.startswith('fatal'):
-                if 'already exists' not in stderr:
-                    sys.exit(1)
-
-            # retrieve user id
-            account_id = None
-            cmd = ('gerrit gsql --format json -c "SELECT account_id '
-                'FROM account_external_ids WHERE external_id=\'username:%s\'"'
-                % (login))
-            stdout, stderr = self._run_cmd(cmd)
-            if not stderr:
-                # load and decode json, extract account id
-                lines = stdout.splitlines()
-                if len(lines)>0:
-                    res = json.loads(lines[0])
-                    try:
-                        account_id = res['columns']['account_id']
-                    except:
-                        pass
-
-            # if found, update ssh keys and openid
-            if account_id:
-                # remove old keys and add new
-                if len(ssh)>0:
-                    cmd = ('gerrit gsql -c "DELETE FROM account_ssh_keys '
-                           'WHERE account_id=%s AND ssh_public_key NOT IN (%s)"' %
-                           (account_id, (', '.join('\''+item+'\'' for item in ssh)) ))
-                else:
-                    cmd = ('gerrit gsql -c "DELETE FROM account_ssh_keys '
-                           'WHERE account_id=%s' % account_id)
-
-                stdout, stderr = self._run_cmd(cmd)
-
-                num_key = 0
-                for ssh_key in ssh:
-                    # insert new keys
-                    cmd = ('gerrit gsql -c "INSERT INTO account_ssh_keys '
-                        '(ssh_public_key, valid, account_id, seq) SELECT '
-                        '%(ssh_key)s, %(valid)s, %(account_id)s, %(num_key)s '
-                        'WHERE NOT EXISTS (SELECT '
-                        'account_id FROM account_ssh_keys WHERE '
-                        'account_id=%(account_id)s AND ssh_public_key=%(ssh_key)s)"' %
-                        {'ssh_key': '\''+ssh_key+'\'', 'valid':'\'Y\'',
-                         'account_id': '\''+account_id+'\'', 'num_key': num_key})
-                    num_key+=1
-                    stdout, stderr = self._run_cmd(cmd)
-
-                # replace external id
-                if openid:
-                    openid = openid.replace('login.launchpad.net', 'login.ubuntu.com')
-                    cmd = ('gerrit gsql -c "DELETE FROM account_external_ids '
-                           'WHERE account_id=%s AND external_id NOT IN (%s) AND '
-                           'external_id LIKE \'http%%\'"' % (account_id, '\''+openid+'\''))
-                    stdout, stderr = self._run_cmd(cmd)
-
-                    # replace launchpad for ubuntu account
-                    cmd = ('gerrit gsql -c "INSERT INTO account_external_ids '
-                           '(account_id, email_address, external_id) SELECT '
-                           '%(account_id)s, %(email_address)s, %(external_id)s WHERE '
-                           'NOT EXISTS (SELECT account_id FROM account_external_ids '
-                           'WHERE account_id=%(account_id)s AND external_id=%(external_id)s)"' %
-                           {'account_id':'\''+account_id+'\'',
-                           'email_address':'\''+str(email)+'\'',
-                           'external_id': '\''+openid+'\''})
-                    stdout, stderr = self._run_cmd(cmd)
-
+            if stderr.startswith('fatal') and 'already exists' not in stderr:
+                log('Error creating account %s: %s' % (login, stderr), ERROR)
+                raise GerritException(stderr)
+            elif stderr and not stderr.startswith('fatal'):
+                log('Error creating account %s: %s' % (login, stderr))
+                failed.append(login)
+            else:
+                created.append(login)
+
+        if created:
+            account_ids.update(self._get_account_ids(created))
+
+        keys = {}
+        openids = {}
+        for login, _, email, ssh, openid in users:
+            account_id = account_ids.get(login)
+            if not account_id:
+                log('Could not find account id for %s, skipping ssh key and '
+                    'OpenID update.' % login)
+                if login not in failed:
+                    failed.append(login)
+                continue
+            keys[account_id] = list(ssh)
+            if openid:
+                openid = openid.replace('login.launchpad.net',
+                                        'login.ubuntu.com')
+                openids[account_id] = (str(email), openid)
+
+        changed = bool(created)
+        if keys and self._update_ssh_keys(keys):
+            changed = True
+        if openids and self._update_openids(openids):
+            changed = True
+        return changed, failed
 
     def create_project(self, project):
         log('Creating gerrit project %s' % project)
@@ -209,6 +436,7 @@ class GerritClient(object):
         stdout, stderr = self._run_cmd(cmd)
         if not stdout and not stderr:
             log('Created new project %s.' % project)
+            metrics.inc('ci_configurator_gerrit_projects_created_total')
             return True
         else:
             log('Error creating project %s, skipping project creation' %
@@ -222,6 +450,44 @@ class GerritClient(object):
         if not stdout and not stderr:
             log('Created new group %s.' % group)
 
-    def flush_cache(self):
-        cmd = ('gerrit flush-caches')
+    def add_group_members(self, group, logins):
+        """Add existing accounts to group."""
+        self._set_members(group, '--add', logins)
+
+    def remove_group_members(self, group, logins):
+        """Remove accounts from group."""
+        self._set_members(group, '--remove', logins)
+
+    def _set_members(self, group, option, logins):
+        if not logins:
+            return
+        log('Updating members of group %s: %s %s' %
+            (group, option, ', '.join(logins)))
+        cmd = ('gerrit set-members "%s"%s' %
+               (group, ''.join(' %s %s' % (option, login)
+                               for login in logins)))
+        stdout, stderr = self._run_cmd(cmd)
+        if stderr.startswith('fatal'):
+            raise GerritException(stderr)
+        elif stderr:
+            log(stderr)
+
+    def flush_cache(self, caches=None):
+        """Flush the given gerrit caches, or all of them if none are given.
+
+        If the given caches cannot be flushed (e.g. one of them does not
+        exist in this gerrit version), all caches are flushed instead.
+
+        :raises GerritException: if flushing fails
+        """
+        cmd = 'gerrit flush-caches'
+        if caches:
+            cmd += ''.join(' --cache %s' % cache for cache in caches)
         stdout, stderr = self._run_cmd(cmd)
+        if stderr and caches:
+            log('Error flushing gerrit caches %s: %s, flushing all caches.' %
+                (', '.join(caches), stderr), ERROR)
+            stdout, stderr = self._run_cmd('gerrit flush-caches --all')
+        if stderr:
+            log('Error flushing gerrit caches: %s' % stderr, ERROR)
+            raise GerritException(stderr)
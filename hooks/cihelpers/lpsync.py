@@ -0,0 +1,630 @@
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import six
+from six.moves import queue
+import yaml
+
+from cihelpers import metrics
+from cihelpers.cron import RunCoordinator
+from cihelpers.gerrit import (
+    ACCOUNT_CACHES,
+    AccountIdCache,
+    GerritClient,
+    GSQL_BATCH_SIZE,
+    log,
+)
+
+# Membership applied by the last successful sync, used to only push users
+# that were added, removed or changed since then.
+SNAPSHOT_FILE = 'membership-snapshot.json'
+# Older snapshots are ignored so that a full push happens at least this often
+# (seconds), repairing any changes made to gerrit behind the sync's back.
+SNAPSHOT_MAX_AGE = 24 * 60 * 60
+# login -> OpenID local id, so discovery only runs for users not seen before.
+OPENID_CACHE_FILE = 'openid-cache.json'
+# A user's OpenID practically never changes: entries older than this (seconds)
+# are still used, and refreshed in the background.
+OPENID_CACHE_TTL = 30 * 24 * 60 * 60
+# Upper bound on background refreshes per run, spreading the refresh of a
+# large, uniformly old cache over several runs.
+OPENID_MAX_REFRESH = 50
+# Resolved team members, reused while their team membership is unchanged.
+MEMBER_CACHE_FILE = 'member-cache.json'
+# Person details (name, email, ssh keys) are not covered by the membership
+# etag, so members are re-resolved after at most this many seconds. Each
+# login expires somewhere between half and all of it, spreading the refresh
+# of a large team over many runs.
+MEMBER_MAX_AGE = 6 * 60 * 60
+# login -> gerrit account id, kept out of unit data so a long sync never
+# holds the charm's state database locked while hooks need it.
+ACCOUNT_ID_CACHE_FILE = 'account-id-cache.json'
+# Held for the duration of a sync so cron runs never overlap.
+LOCK_FILE = 'sync.lock'
+# Members are resolved (person, email, ssh keys, OpenID) by this many
+# concurrent workers.
+LP_WORKERS = 8
+# Users buffered between the Launchpad reader and the gerrit writer.
+QUEUE_SIZE = 1000
+
+
+def load_json(path, default=None):
+    if not os.path.isfile(path):
+        return default
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return default
+
+
+def save_json(path, data):
+    """Write data as json, replacing path atomically."""
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+class OpenIDCache(object):
+    """Persistent login -> OpenID map in front of a discover(login) function.
+
+    Unknown logins are discovered synchronously. Expired entries are
+    returned as they are and re-discovered on a background thread.
+    """
+
+    def __init__(self, path, discover, ttl=OPENID_CACHE_TTL,
+                 max_refresh=OPENID_MAX_REFRESH):
+        self.path = path
+        self.discover = discover
+        self.ttl = ttl
+        self.max_refresh = max_refresh
+        self._entries = load_json(path, {})
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._pool = None
+
+    def get(self, login):
+        with self._lock:
+            entry = self._entries.get(login)
+        if entry is None:
+            openid = self.discover(login)
+            self._set(login, openid)
+            return openid
+
+        openid, fetched = entry
+        if time.time() - fetched > self.ttl:
+            self._refresh_later(login)
+        return openid
+
+    def _set(self, login, openid):
+        with self._lock:
+            self._entries[login] = [openid, time.time()]
+
+    def _refresh_later(self, login):
+        with self._lock:
+            if (login in self._refreshing or
+                    len(self._refreshing) >= self.max_refresh):
+                return
+            self._refreshing.add(login)
+            if self._pool is None:
+                self._pool = ThreadPool(1)
+        self._pool.apply_async(self._refresh, (login,))
+
+    def _refresh(self, login):
+        try:
+            self._set(login, self.discover(login))
+        except Exception:
+            # keep using the old entry, it will be retried on a later run
+            pass
+
+    def save(self):
+        with self._lock:
+            entries = dict(self._entries)
+        save_json(self.path, entries)
+
+    def close(self):
+        """Wait for background refreshes, then save."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self.save()
+
+
+class MemberCache(object):
+    """Persistent cache of resolved team members.
+
+    Each entry holds what resolving a login gave, ('T', team_name) or
+    ('U', user tuple or None), along with the http_etag of the team
+    membership it was reached through. Entries are reused while that etag is
+    unchanged and they are younger than their share of max_age, so an
+    unchanged team costs its members_details pages and nothing per member.
+    """
+
+    def __init__(self, path, max_age=MEMBER_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._entries = load_json(path, {})
+        self._seen = set()
+
+    def _max_age(self, login):
+        spread = zlib.crc32(login.encode('utf-8')) % 1000 / 2000.0
+        return self.max_age * (0.5 + spread)
+
+    def get(self, login, etag):
+        """Returns the cached (kind, value) for login, or None."""
+        entry = self._entries.get(login)
+        if (not entry or not etag or entry['etag'] != etag or
+                time.time() - entry['fetched'] > self._max_age(login)):
+            return None
+        self._seen.add(login)
+        kind, value = entry['kind'], entry['value']
+        if kind == 'U' and value:
+            login, full_name, email, ssh_keys, openid = value
+            value = (login, full_name, email, tuple(ssh_keys), openid)
+        return kind, value
+
+    def set(self, login, etag, kind, value):
+        self._seen.add(login)
+        self._entries[login] = {'etag': etag, 'fetched': time.time(),
+                                'kind': kind, 'value': value}
+
+    def save(self):
+        save_json(self.path, self._entries)
+
+    def close(self):
+        """Save the entries used this run, dropping members that are gone."""
+        self._entries = dict((login, entry)
+                             for login, entry in self._entries.items()
+                             if login in self._seen)
+        self.save()
+
+
+def get_type(in_type):
+    if in_type == "RSA":
+        return "ssh-rsa"
+    else:
+        return "ssh-dsa"
+
+
+def assert_is_valid_email(email):
+    if not email or not re.search(r'.+?@.+?\..+?', email):
+        msg = "invalid email address '%s'" % (email)
+        raise Exception(msg)
+
+
+def discover_openid(lp_user):
+    from openid.consumer import consumer
+    from openid.cryptutil import randomString
+
+    k = dict(id=randomString(16, '0123456789abcdef'))
+    openid_consumer = consumer.Consumer(k, None)
+    openid_request = openid_consumer.begin(
+        "https://launchpad.net/~%s" % lp_user)
+    return openid_request.endpoint.getLocalID()
+
+
+class LaunchpadReader(object):
+    """Walks Launchpad teams, yielding a (login, full_name, email, ssh_keys,
+    openid) tuple for every approved member of them and their sub-teams.
+
+    Teams and people are fetched once per reader into a membership graph, so
+    groups sharing teams cost no further Launchpad requests and each group
+    still gets all of its members.
+
+    :param login: callable returning a new Launchpad session. Each worker
+                  thread gets its own, launchpadlib's http client must not be
+                  shared between threads.
+    :param skip_errors: exceptions that skip a sub-team instead of failing the
+                        sync, e.g. Unauthorized for private teams.
+    """
+
+    def __init__(self, login, openid_cache, member_cache, workers=LP_WORKERS,
+                 skip_errors=()):
+        self.login = login
+        self.openid_cache = openid_cache
+        self.member_cache = member_cache
+        self.skip_errors = skip_errors
+        self._local = threading.local()
+        self._pool = ThreadPool(workers)
+        # membership graph: team -> member logins, login -> (kind, value)
+        self._teams = {}
+        self._people = {}
+
+    def session(self):
+        if not hasattr(self._local, 'launchpad'):
+            self._local.launchpad = self.login()
+        return self._local.launchpad
+
+    def resolve_member(self, login):
+        """Resolve a single team member, run by the worker pool.
+
+        Returns ('T', team_name) for teams, ('U', user_tuple) for users and
+        ('U', None) for users that have to be skipped.
+        """
+        member = self.session().people[login]
+        if member.is_team:
+            return ('T', member.name)
+
+        openid = self.openid_cache.get(login)
+        full_name = member.display_name.encode('ascii', 'replace')
+        if six.PY3:
+            full_name = full_name.decode('ascii')
+        email = ''
+        errmsg = ("failed to get valid email address for '%s' (%s) - "
+                  "skipping")
+        try:
+            email = member.preferred_email_address.email
+            assert_is_valid_email(email)
+        except Exception as exc:
+            log(errmsg % (login, str(exc)))
+            return ('U', None)
+        except:
+            # Do catchall just in case an exception is raised that does not
+            # inherit Exception.
+            log(errmsg % (login, 'no exception info available'))
+            return ('U', None)
+
+        ssh_keys = tuple(
+            "{} {} {}".format(get_type(key.keytype), key.keytext,
+                              key.comment).strip()
+            for key in member.sshkeys)
+        return ('U', (login, full_name, email, ssh_keys, openid))
+
+    def group_users(self, teams):
+        """Yields every user of teams and their sub-teams once."""
+        seen = set()
+        for team in teams:
+            log("Reading users for team %s" % team)
+            for user in self._walk(team, team, seen):
+                yield user
+
+    def _walk(self, team, path, seen):
+        for login in self.team_members(team):
+            if login in seen:
+                log("'%s' details already identified - skipping alternate" %
+                    (login))
+                continue
+            seen.add(login)
+            kind, value = self._people[login]
+            log('{}-entry: {}/{}'.format(kind, path, login))
+            if kind == 'U':
+                if value:
+                    yield value
+                continue
+
+            # recurse down into sub-teams
+            sub_team = "{}/{}".format(path, value)
+            try:
+                self.team_members(login)
+            except self.skip_errors as exc:
+                log("WARN: skipping team=%s (%s)" %
+                    (sub_team, exc.__class__.__name__))
+                continue
+            for user in self._walk(login, sub_team, seen):
+                yield user
+
+    def team_members(self, team):
+        """Logins of the approved members of team.
+
+        Teams and people are fetched from Launchpad once per reader, groups
+        sharing teams are served from the membership graph built so far.
+        """
+        if team in self._teams:
+            return self._teams[team]
+
+        logins = []
+        etags = {}
+        for detail in self.session().people[team].members_details:
+            # detail.self_link ==
+            # 'https://api.launchpad.net/1.0/~team/+member/${username}'
+            login = detail.self_link.split('/')[-1]
+
+            if detail.status not in ("Approved", "Administrator"):
+                continue
+            logins.append(login)
+            etags[login] = detail.http_etag
+
+        # Reuse members whose membership is unchanged since they were
+        # resolved, resolve the others concurrently.
+        todo = []
+        for login in logins:
+            if login in self._people:
+                continue
+            cached = self.member_cache.get(login, etags[login])
+            if cached:
+                self._people[login] = cached
+            else:
+                todo.append(login)
+        for login, (kind, value) in zip(todo, self._pool.map(
+                self.resolve_member, todo)):
+            self.member_cache.set(login, etags[login], kind, value)
+            self._people[login] = (kind, value)
+
+        self._teams[team] = logins
+        return logins
+
+    def save(self):
+        self.openid_cache.save()
+        self.member_cache.save()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.openid_cache.close()
+        self.member_cache.close()
+
+
+def user_record(user):
+    """Comparable, json serialisable form of a
+    (login, full_name, email, ssh_keys, openid) user tuple, minus the login.
+    """
+    login, full_name, email, ssh_keys, openid = user
+    return [full_name, email, sorted(ssh_keys), openid]
+
+
+def load_snapshot(path, max_age=SNAPSHOT_MAX_AGE):
+    """Returns the last applied membership as ({group: {login: record}},
+    taken), taken being the time of the full push it descends from.
+
+    Missing, unreadable or expired snapshots return no groups and the
+    current time, which makes this sync a full push of every user.
+    """
+    snapshot = load_json(path)
+    now = time.time()
+    if not snapshot or now - snapshot.get('time', 0) > max_age:
+        return {}, now
+    return snapshot.get('groups', {}), snapshot['time']
+
+
+def save_snapshot(path, groups, taken):
+    """Record groups ({group: {login: record}}) as applied."""
+    save_json(path, {'time': taken, 'groups': groups})
+
+
+def diff_group(previous, users):
+    """Compare a group's users with its last applied membership.
+
+    :param previous: {login: record} from the snapshot
+    :param users: list of (login, full_name, email, ssh_keys, openid)
+    :returns: (records, changed, removed) where records is the new
+              {login: record} for the group, changed the user tuples that
+              were added or changed and removed the logins no longer in the
+              group.
+    """
+    diff = GroupDiff(previous)
+    changed = [user for user in users if diff.add(user)]
+    return diff.records, changed, diff.removed()
+
+
+class GroupDiff(object):
+    """diff_group for users that arrive one at a time."""
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.records = {}
+        self.failed = set()
+
+    def add(self, user):
+        """Record user, returns True if it was added or changed."""
+        record = user_record(user)
+        self.records[user[0]] = record
+        return self.previous.get(user[0]) != record
+
+    def discard(self, logins):
+        """Leave logins that could not be applied out of the records, so
+        they are retried next time instead of being taken as applied."""
+        for login in logins:
+            self.records.pop(login, None)
+            self.failed.add(login)
+
+    def removed(self):
+        return sorted(login for login in self.previous
+                      if login not in self.records and
+                      login not in self.failed)
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(out, stop, item):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped()
+
+
+def read_groups(groups, reader, out, stop):
+    """Producer: streams ('group', name), ('user', user)... ('end', name) for
+    every group into out, followed by None. A failure is passed on as
+    ('error', exc_info) instead.
+    """
+    try:
+        for group, teams in groups.items():
+            _put(out, stop, ('group', group))
+            for user in reader.group_users(teams.split(' ')):
+                _put(out, stop, ('user', user))
+            reader.save()
+            _put(out, stop, ('end', group))
+        _put(out, stop, None)
+    except _Stopped:
+        pass
+    except Exception:
+        _put(out, stop, ('error', sys.exc_info()))
+
+
+def _apply_users(gerrit_client, group, users, diff):
+    """Write users to gerrit, dropping the ones that failed from diff.
+
+    :returns: True if gerrit account caches need flushing
+    """
+    changed, failed = gerrit_client.create_users_batch(group, users,
+                                                       flush=False)
+    if failed:
+        log("Group %s: could not apply %s, retrying next sync" %
+            (group, ', '.join(failed)))
+        diff.discard(failed)
+    return changed
+
+
+def sync_groups(groups, reader, gerrit_client, snapshot_path,
+                queue_size=QUEUE_SIZE):
+    """Sync the members of groups ({group: 'team team...'}) to gerrit.
+
+    Launchpad is read on a separate thread that streams users through a
+    bounded queue to the gerrit writer (the calling thread), so writes
+    overlap with reads and at most queue_size users are held in flight.
+    Only users added, removed or changed since the last applied snapshot are
+    written.
+
+    :returns: (changed, removed) user counts
+    """
+    snapshot, taken = load_snapshot(snapshot_path)
+    applied = dict((group, records) for group, records in snapshot.items()
+                   if group in groups)
+    users = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(target=read_groups,
+                                args=(groups, reader, users, stop))
+    producer.daemon = True
+    producer.start()
+
+    totals = [0, 0]
+    need_flush = False
+    try:
+        for kind, value in iter(users.get, None):
+            if kind == 'error':
+                six.reraise(*value)
+            elif kind == 'group':
+                group = value
+                diff = GroupDiff(snapshot.get(group, {}))
+                changed = []
+                group_changed = 0
+                try:
+                    log("Creating group %s" % group)
+                    gerrit_client.create_group(group)
+                except Exception:
+                    log("Skipping group creation")
+            elif kind == 'user':
+                if diff.add(value):
+                    changed.append(value)
+                    group_changed += 1
+                if len(changed) >= GSQL_BATCH_SIZE:
+                    need_flush = _apply_users(gerrit_client, group, changed,
+                                              diff) or need_flush
+                    changed = []
+            elif kind == 'end':
+                if changed:
+                    need_flush = _apply_users(gerrit_client, group, changed,
+                                              diff) or need_flush
+                group_changed -= len(diff.failed)
+                removed = diff.removed()
+                if removed:
+                    gerrit_client.remove_group_members(group, removed)
+                log("Group %s: %d users, %d added or changed, %d removed" %
+                    (group, len(diff.records), group_changed, len(removed)))
+                totals[0] += group_changed
+                totals[1] += len(removed)
+                metrics.inc('ci_configurator_lp_sync_users_total',
+                            group_changed, change='added')
+                metrics.inc('ci_configurator_lp_sync_users_total',
+                            len(removed), change='removed')
+                applied[group] = diff.records
+                save_snapshot(snapshot_path, applied, taken)
+    finally:
+        stop.set()
+        producer.join()
+        if need_flush:
+            gerrit_client.flush_cache(ACCOUNT_CACHES)
+
+    log("Synced %d added or changed and %d removed users" % tuple(totals))
+    return tuple(totals)
+
+
+def main(argv, groups_file, launchpad_dir, ssh_port):
+    """Entry point of scripts/query_lp_members.py.
+
+    Runs are coordinated through a lock in launchpad_dir: a run starting
+    while the previous one is still going, or right after a long one, is
+    skipped.
+
+    :param argv: [admin_username, admin_privkey]
+    """
+    logging.basicConfig(level=logging.INFO)
+    if len(argv) < 2:
+        log("ERROR: Please send user and private key in parameters.")
+        return 1
+    if not os.path.exists(launchpad_dir):
+        os.makedirs(launchpad_dir)
+
+    coordinator = RunCoordinator(os.path.join(launchpad_dir, LOCK_FILE),
+                                 name='launchpad_sync')
+    start = time.time()
+    try:
+        ran, result = coordinator.run(sync, argv[0], argv[1], groups_file,
+                                      launchpad_dir, ssh_port)
+        if ran:
+            metrics.observe('ci_configurator_lp_sync_seconds',
+                            time.time() - start,
+                            status='failed' if result else 'ok')
+    finally:
+        metrics.flush()
+    if not ran:
+        log("Skipping launchpad sync: %s" % result)
+        return 0
+    return result
+
+
+def sync(admin_username, admin_privkey, groups_file, launchpad_dir,
+         ssh_port):
+    from launchpadlib.launchpad import Launchpad
+    from launchpadlib.uris import LPNET_SERVICE_ROOT
+    from lazr.restfulclient.errors import Unauthorized
+
+    cache_dir = os.path.join(launchpad_dir, 'cache')
+    credentials = os.path.join(launchpad_dir, 'creds')
+
+    def login():
+        return Launchpad.login_with('Canonical CI Gerrit User Sync',
+                                    LPNET_SERVICE_ROOT, cache_dir,
+                                    credentials_file=credentials)
+
+    with open(groups_file, 'r') as f:
+        groups = yaml.load(f)
+
+    reader = LaunchpadReader(
+        login,
+        OpenIDCache(os.path.join(launchpad_dir, OPENID_CACHE_FILE),
+                    discover_openid),
+        MemberCache(os.path.join(launchpad_dir, MEMBER_CACHE_FILE)),
+        skip_errors=(Unauthorized,))
+    # log in once up front, so workers find the service description cached
+    reader.session()
+    gerrit_client = GerritClient(
+        host='localhost', user=admin_username, port=ssh_port,
+        key_file=admin_privkey,
+        account_ids=AccountIdCache(
+            os.path.join(launchpad_dir, ACCOUNT_ID_CACHE_FILE)))
+    try:
+        sync_groups(groups, reader, gerrit_client,
+                    os.path.join(launchpad_dir, SNAPSHOT_FILE))
+    except Exception as e:
+        log("ERROR creating users %s" % str(e))
+        return 1
+    finally:
+        reader.close()
+        # Workaround https://github.com/paramiko/paramiko/issues/17
+        gerrit_client.ssh.close()
+    return 0
@@ -0,0 +1,130 @@
+import fcntl
+import json
+import os
+
+# node-exporter's textfile collector directory, metrics are only written if
+# it exists.
+TEXTFILE_DIR = '/var/lib/prometheus/node-exporter'
+TEXTFILE = 'ci_configurator.prom'
+# counters and histograms accumulated by all runs so far
+STATE_FILE = 'ci_configurator.json'
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+METRICS = {
+    'ci_configurator_hook_duration_seconds': (
+        HISTOGRAM, 'Duration of charm hooks.'),
+    'ci_configurator_repo_fetch_seconds': (
+        HISTOGRAM, 'Time spent fetching the config repository.'),
+    'ci_configurator_repo_fetch_bytes_total': (
+        COUNTER, 'Growth of the config repository checkout on fetch.'),
+    'ci_configurator_jjb_jobs_total': (
+        COUNTER, 'Jenkins jobs updated or skipped as unchanged by '
+                 'jenkins-job-builder.'),
+    'ci_configurator_gerrit_projects_created_total': (
+        COUNTER, 'Projects created in gerrit.'),
+    'ci_configurator_lp_sync_seconds': (
+        HISTOGRAM, 'Duration of Launchpad syncs.'),
+    'ci_configurator_lp_sync_users_total': (
+        COUNTER, 'Gerrit users added or changed and removed by the '
+                 'Launchpad sync.'),
+    'ci_configurator_cron_stuck_total': (
+        COUNTER, 'Cron runs skipped behind a previous run that looks hung.'),
+    'ci_configurator_restarts_total': (
+        COUNTER, 'Service restarts triggered by the configurator.'),
+    'ci_configurator_reloads_total': (
+        COUNTER, 'In place service reloads triggered by the configurator.'),
+}
+
+_pending = {}
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add value to counter name."""
+    series = _pending.setdefault(name, {})
+    key = _labels(labels)
+    series[key] = series.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Record value in histogram name."""
+    series = _pending.setdefault(name, {})
+    key = _labels(labels)
+    if key not in series:
+        series[key] = [0] * (len(BUCKETS) + 2)
+    histogram = series[key]
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            histogram[i] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+
+def _merge(state, pending):
+    for name, series in pending.items():
+        merged = state.setdefault(name, {})
+        for key, value in series.items():
+            if METRICS[name][0] == HISTOGRAM:
+                current = merged.get(key) or [0] * len(value)
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+
+def render(state):
+    lines = []
+    for name in sorted(state):
+        kind, help_text = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for key, value in sorted(state[name].items()):
+            if kind == COUNTER:
+                lines.append('%s{%s} %s' % (name, key, value))
+                continue
+            sep = ',' if key else ''
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-2] +
+                                    [value[-1]]):
+                lines.append('%s_bucket{%s%sle="%s"} %s' %
+                             (name, key, sep, bound, count))
+            lines.append('%s_sum{%s} %s' % (name, key, value[-2]))
+            lines.append('%s_count{%s} %s' % (name, key, value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def flush(textfile_dir=None):
+    """Merge the metrics recorded by this process into the totals of
+    previous runs and rewrite the textfile.
+
+    Hooks and the Launchpad sync cron job flush concurrently, so the
+    read-merge-write cycle runs under a lock.
+    """
+    global _pending
+    textfile_dir = textfile_dir or TEXTFILE_DIR
+    if not _pending or not os.path.isdir(textfile_dir):
+        return
+
+    state_path = os.path.join(textfile_dir, STATE_FILE)
+    with open(state_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+        _merge(state, _pending)
+        _pending = {}
+
+        for path, content in ((state_path, json.dumps(state)),
+                              (os.path.join(textfile_dir, TEXTFILE),
+                               render(state))):
+            # node-exporter must never read a partial file
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(content)
+            os.rename(tmp, path)
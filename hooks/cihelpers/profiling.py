@@ -0,0 +1,123 @@
+import contextlib
+import functools
+import os
+import subprocess
+import threading
+import time
+
+# Values of the hook-profiling config option.
+TIMING = 'timing'
+CPROFILE = 'cprofile'
+MODES = (TIMING, CPROFILE)
+# subprocess functions timed while profiling
+SUBPROCESS_FUNCS = ('call', 'check_call', 'check_output')
+
+
+class Profiler(object):
+    """Records nested, timed spans of a hook run.
+
+    Spans are only recorded between start() and stop(); otherwise span()
+    and timed() cost a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._start = None
+        self._profile = None
+        self._subprocess = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            depth = self._depth
+            self._depth += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self._depth -= 1
+                self.spans.append((start - self._start, duration, depth,
+                                   name))
+
+    def timed(self, func):
+        """Decorator recording a span for every call of func."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            with self.span(func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def start(self, mode):
+        if self.enabled or mode not in MODES:
+            return
+        self.spans = []
+        self._depth = 0
+        self._start = time.time()
+        self.enabled = True
+        for name in SUBPROCESS_FUNCS:
+            self._subprocess[name] = getattr(subprocess, name)
+            setattr(subprocess, name,
+                    self._timed_subprocess(self._subprocess[name]))
+        if mode == CPROFILE:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def _timed_subprocess(self, func):
+        @functools.wraps(func)
+        def wrapper(cmd, *args, **kwargs):
+            if isinstance(cmd, (list, tuple)):
+                name = ' '.join(str(arg) for arg in cmd)
+            else:
+                name = str(cmd)
+            with self.span('subprocess: %s' % name[:80]):
+                return func(cmd, *args, **kwargs)
+        return wrapper
+
+    def stop(self, report_dir, name):
+        """Stop recording and write the report of this run to
+        report_dir/<name>.txt, and the cProfile stats to <name>.prof.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        for func_name, func in self._subprocess.items():
+            setattr(subprocess, func_name, func)
+        self._subprocess = {}
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(os.path.join(report_dir,
+                                                  '%s.prof' % name))
+            self._profile = None
+        with open(os.path.join(report_dir, '%s.txt' % name), 'w') as f:
+            f.write(self.report(name))
+
+    def report(self, name):
+        total = sum(duration for _, duration, depth, _ in self.spans
+                    if depth == 0)
+        lines = ['%s: %.3fs, started %s' %
+                 (name, total, time.strftime('%Y-%m-%d %H:%M:%S',
+                                             time.localtime(self._start)))]
+        lines.append('%9s %9s  %s' % ('offset', 'duration', 'span'))
+        for offset, duration, depth, span in sorted(
+                self.spans, key=lambda span: (span[0], span[2])):
+            lines.append('%8.3fs %8.3fs  %s%s' %
+                         (offset, duration, '  ' * depth, span))
+        return '\n'.join(lines) + '\n'
+
+
+profiler = Profiler()
+span = profiler.span
+timed = profiler.timed
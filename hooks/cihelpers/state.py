@@ -0,0 +1,56 @@
+import hashlib
+import json
+import time
+
+from charmhelpers.core import unitdata
+
+KEY_PREFIX = 'ci.state.'
+
+
+def fingerprint(*inputs):
+    """Stable hash of json serialisable inputs."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)
+                          .encode('utf-8')).hexdigest()
+
+
+class State(object):
+    """What a subsystem last did successfully, kept in unitdata between
+    hooks so unchanged work can be skipped.
+
+    :ivar inputs: fingerprint of the inputs of the last successful run
+    :ivar last_success: time of the last successful run
+    :ivar info: what that run recorded about itself, e.g. the version or
+                revision it installed
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = KEY_PREFIX + name
+        data = unitdata.kv().get(self.key) or {}
+        self.inputs = data.get('inputs')
+        self.last_success = data.get('last_success')
+        self.info = data.get('info') or {}
+
+    def needs_work(self, *inputs):
+        """True unless the last successful run had the same inputs."""
+        return fingerprint(*inputs) != self.inputs
+
+    def done(self, *inputs, **info):
+        """Record a successful run with inputs."""
+        self.inputs = fingerprint(*inputs)
+        self.last_success = time.time()
+        self.info = info
+        kv = unitdata.kv()
+        kv.set(self.key, {'inputs': self.inputs,
+                          'last_success': self.last_success,
+                          'info': self.info})
+        kv.flush()
+
+    def reset(self):
+        """Forget the last run, so the next one does all the work."""
+        self.inputs = None
+        self.last_success = None
+        self.info = {}
+        kv = unitdata.kv()
+        kv.unset(self.key)
+        kv.flush()
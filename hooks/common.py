@@ -1,11 +1,23 @@
+import hashlib
 import os
 import pwd
+import re
 import shutil
 import subprocess
-import yaml
+import time
 
 from charmhelpers.core.host import adduser, add_user_to_group, mkdir
-from charmhelpers.core.hookenv import charm_dir, config, log, ERROR
+from charmhelpers.core.hookenv import (
+    charm_dir,
+    config,
+    log,
+    related_units,
+    relation_get,
+    relation_ids,
+    ERROR,
+)
+from cihelpers import metrics
+from cihelpers.profiling import timed
 
 PACKAGES = [
     'bzr'
@@ -91,7 +103,26 @@ def update_configs_from_git_repo(repo, revision=None):
                 cwd=CI_CONFIG_DIR)
 
 
+def _is_pinned(repo_rcs, revision):
+    """True if revision always refers to the same tree."""
+    if repo_rcs == 'bzr':
+        # revnos and revids; last:N, -N, tag:, date:, branch: ... move
+        return bool(revision) and re.match(
+            r'^((revno:)?[0-9]+(\.[0-9]+)*|revid:.+)$', revision) is not None
+    return bool(revision) and re.match('^[0-9a-f]{40}$', revision) is not None
+
+
+@timed
 def update_configs_from_repo(repo_rcs, repo, revision=None):
+    # unitdata (sqlite3) is only needed by hooks updating the repo
+    from cihelpers.state import State
+    state = State('config-repo')
+    if (_is_pinned(repo_rcs, revision) and os.path.isdir(CI_CONFIG_DIR) and
+            not state.needs_work(repo_rcs, repo, revision)):
+        log('*** %s already at %s revision %s, skipping update.' %
+            (CI_CONFIG_DIR, repo, revision))
+        return
+
     log('*** Updating %s from remote repo: %s' %
         (CI_CONFIG_DIR, repo))
     subprocess.check_call(['chown', '-R', CI_USER, CONFIG_DIR])
@@ -100,7 +131,30 @@ def update_configs_from_repo(repo_rcs, repo, revision=None):
         'bzr': update_configs_from_bzr_repo,
         'git': update_configs_from_git_repo,
     }
-    return repo_funcs[repo_rcs](repo, revision)
+    size = dir_size(CI_CONFIG_DIR)
+    start = time.time()
+    result = repo_funcs[repo_rcs](repo, revision)
+    metrics.observe('ci_configurator_repo_fetch_seconds',
+                    time.time() - start, rcs=repo_rcs)
+    metrics.inc('ci_configurator_repo_fetch_bytes_total',
+                max(0, dir_size(CI_CONFIG_DIR) - size), rcs=repo_rcs)
+    state.done(repo_rcs, repo, revision, revision=revision)
+    return result
+
+
+def relation_snapshot(reltype):
+    """Settings of every unit related over reltype, as a list of
+    (rid, unit, settings) tuples.
+
+    Each unit's settings are read with a single relation-get (cached for the
+    rest of the hook), rather than one relation-get per attribute.
+    """
+    snapshot = []
+    for rid in relation_ids(reltype):
+        for unit in related_units(rid):
+            settings = relation_get(rid=rid, unit=unit) or {}
+            snapshot.append((rid, unit, settings))
+    return snapshot
 
 
 def load_control():
@@ -108,6 +162,7 @@ def load_control():
         log('No control.yml found in repo at @ %s.' % CI_CONTROL_FILE)
         return None
 
+    import yaml
     with open(CI_CONTROL_FILE) as control:
         return yaml.load(control)
 
@@ -127,6 +182,34 @@ def sync_dir(src, dst):
             shutil.copy(_path, dst)
 
 
+def dir_size(path):
+    """Total size in bytes of the files under path."""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            _path = os.path.join(root, name)
+            if not os.path.islink(_path):
+                size += os.path.getsize(_path)
+    return size
+
+
+def dir_hash(path):
+    """sha256 of the names and contents of all files under path, or None if
+    path does not exist.
+    """
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            _path = os.path.join(root, name)
+            h.update(os.path.relpath(_path, path).encode('utf-8') + b'\0')
+            with open(_path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
 def _run_as_user(user):
     try:
         user = pwd.getpwnam(user)
@@ -142,8 +225,9 @@ def _run_as_user(user):
     return _inner
 
 
-def run_as_user(user, cmd, cwd='/'):
-    return subprocess.check_output(cmd, preexec_fn=_run_as_user(user), cwd=cwd)
+def run_as_user(user, cmd, cwd='/', stderr=None):
+    return subprocess.check_output(cmd, preexec_fn=_run_as_user(user), cwd=cwd,
+                                   stderr=stderr)
 
 
 def ensure_user():
@@ -17,8 +17,6 @@ from charmhelpers.core.hookenv import (
     config,
     log,
     relation_ids,
-    relation_get,
-    related_units,
     WARNING,
     INFO,
     ERROR
@@ -28,7 +26,9 @@ from cihelpers.gerrit import (
     start_gerrit,
     stop_gerrit
 )
-from cihelpers import cron
+from cihelpers import cron, metrics
+from cihelpers.profiling import timed
+from cihelpers.state import State
 
 GERRIT_INIT_SCRIPT = '/etc/init.d/gerrit'
 GERRIT_CONFIG_DIR = os.path.join(common.CI_CONFIG_DIR, 'gerrit')
@@ -68,11 +68,22 @@ def update_theme(theme_dest, static_dest):
             'Skipping theme refresh.' % THEME_DIR, level=WARNING)
         return False
 
+    state = State('gerrit-theme')
+    sources = (common.dir_hash(theme_orig), common.dir_hash(static_orig))
+    # the installed files too, so that a wiped site is reinstalled
+    inputs = sources + (common.dir_hash(theme_dest),
+                        common.dir_hash(static_dest))
+    if not state.needs_work(*inputs):
+        log('Gerrit theme unchanged, skipping theme refresh.')
+        return False
+
     log('Installing theme from %s to %s.' % (theme_orig, theme_dest))
     common.sync_dir(theme_orig, theme_dest)
     log('Installing static files from %s to %s.' % (theme_orig, theme_dest))
     common.sync_dir(static_orig, static_dest)
 
+    state.done(*(sources + (common.dir_hash(theme_dest),
+                            common.dir_hash(static_dest))))
     return True
 
 
@@ -82,6 +93,13 @@ def update_hooks(hooks_dest, settings):
             HOOKS_DIR, level=WARNING)
         return False
 
+    state = State('gerrit-hooks')
+    sources = (common.dir_hash(HOOKS_DIR), sorted(settings.items()))
+    # the installed hooks too, so that a wiped site is reinstalled
+    if not state.needs_work(*(sources + (common.dir_hash(hooks_dest),))):
+        log('Gerrit hooks unchanged, skipping hooks refresh.')
+        return False
+
     log('Installing gerrit hooks in %s to %s.' % (HOOKS_DIR, hooks_dest))
     common.sync_dir(HOOKS_DIR, hooks_dest)
 
@@ -97,6 +115,7 @@ def update_hooks(hooks_dest, settings):
             with open(current_path, 'w') as f:
                 f.write(contents)
 
+    state.done(*(sources + (common.dir_hash(hooks_dest),)))
     return True
 
 
@@ -464,10 +483,10 @@ def get_relation_settings(keys):
     """
     settings = {}
     try:
-        for rid in relation_ids('gerrit-configurator'):
-            for unit in related_units(rid):
-                for key in keys:
-                    settings[key] = relation_get(key, rid=rid, unit=unit)
+        for rid, unit, unit_settings in common.relation_snapshot(
+                'gerrit-configurator'):
+            for key in keys:
+                settings[key] = unit_settings.get(key)
 
     except Exception as exc:
         log('Failed to get gerrit relation data (%s).' % (exc), level=WARNING)
@@ -482,6 +501,7 @@ def get_relation_settings(keys):
     return settings
 
 
+@timed
 def update_gerrit():
     if not relation_ids('gerrit-configurator'):
         log('*** No relation to gerrit, skipping update.')
@@ -526,5 +546,6 @@ def update_gerrit():
     restart_req.append(update_theme(theme_dir, static_dir))
 
     if any(restart_req):
+        metrics.inc('ci_configurator_restarts_total', service='gerrit')
         stop_gerrit()
         start_gerrit()
@@ -3,25 +3,23 @@
 ''''which python2 >/dev/null 2>&1 && exec /usr/bin/env python2 "$0" "$@" # '''
 ''''exec echo "Error: I can't find python anywhere" # '''
 
+import importlib
 import os
 import sys
 import shlex
 import shutil
 import subprocess
-
-import gerrit
-import jjb
-import zuul
+import time
 
 from utils import (
     is_ci_configured,
     is_valid_config_repo,
 )
 
-from charmhelpers.fetch import apt_install, filter_installed_packages
-from cihelpers import cron
+from cihelpers import metrics, profiling
 import common
 from charmhelpers.core.hookenv import (
+    buffer_logs,
     charm_dir,
     config,
     log,
@@ -29,24 +27,53 @@ from charmhelpers.core.hookenv import (
     INFO,
     relation_ids,
     related_units,
-    relation_get,
     relation_set,
     Hooks,
     UnregisteredHookError,
     local_unit
 )
 from charmhelpers.core.host import mkdir
-from charmhelpers.core.templating import render
 
 hooks = Hooks()
 
+PROFILE_DIR = os.path.join(common.CONFIG_DIR, 'hook-profiles')
+
+# Modules each hook needs, imported by load_hook_modules() before the hook
+# runs so that short hooks do not pay for importing everything. Hooks missing
+# here get all of them. Slow imports needed by few functions (yaml, unitdata,
+# jjb in zuul, distutils in hookenv) are done inside those functions, so the
+# modules listed here are what each hook imports beyond hooks.py itself.
+CONFIG_MODULES = ('cihelpers.cron', 'gerrit', 'jjb', 'zuul')
+HOOK_MODULES = {
+    'install': ('charmhelpers.fetch',),
+    'config-changed': CONFIG_MODULES,
+    'upgrade-charm': CONFIG_MODULES,
+    'jenkins-configurator-relation-joined': ('jjb',),
+    'jenkins-configurator-relation-changed': ('jjb',),
+    'gerrit-configurator-relation-changed': ('gerrit',),
+    'zuul-configurator-relation-changed': ('zuul',),
+    'vault-relation-changed': ('charmhelpers.core.templating',),
+    'vault-relation-joined': (),
+}
+ALL_MODULES = sorted(set(sum(HOOK_MODULES.values(), ())))
+
+# set by load_hook_modules()
+cron = fetch = gerrit = jjb = templating = zuul = None
+
+
+def load_hook_modules(hook_name):
+    """Import the modules hook_name needs as globals of this module."""
+    for name in HOOK_MODULES.get(hook_name, ALL_MODULES):
+        globals()[name.rsplit('.', 1)[-1]] = importlib.import_module(name)
+
 
 @hooks.hook()
 def install():
     common.ensure_user()
     if not os.path.exists(common.CONFIG_DIR):
         os.mkdir(common.CONFIG_DIR)
-    apt_install(filter_installed_packages(common.PACKAGES), fatal=True)
+    fetch.apt_install(fetch.filter_installed_packages(common.PACKAGES),
+                      fatal=True)
 
 
 def run_relation_hooks():
@@ -158,12 +185,11 @@ def zuul_configurator_relation_changed(rid=None):
 @hooks.hook('vault-relation-changed')
 def vault_relation_changed(rid=None):
     content = {'host': None, 'port': None, 'token': None}
-    for rid in relation_ids('vault'):
-        for unit in related_units(rid):
-            for key in content:
-                value = relation_get(key, rid=rid, unit=unit)
-                if value:
-                    content[key] = value
+    for _, _, settings in common.relation_snapshot('vault'):
+        for key in content:
+            value = settings.get(key)
+            if value:
+                content[key] = value
     if not all(content.values()):
         return
     shutil.copyfile(
@@ -173,7 +199,8 @@ def vault_relation_changed(rid=None):
     shutil.move('/tmp/vault', '/usr/local/bin/vault')
     os.chmod('/usr/local/bin/vault', 0o755)
 
-    render('vault-client', '/usr/local/bin/vault-client', content, perms=0o755)
+    templating.render('vault-client', '/usr/local/bin/vault-client', content,
+                      perms=0o755)
     user = 'jenkins'
     cmd = "/bin/su -c '/usr/local/bin/vault-client auth %s' %s" % \
         (content['token'], user)
@@ -186,10 +213,21 @@ def vault_relation_joined(rid=None):
 
 
 def main():
+    buffer_logs()
+    hook_name = os.path.basename(sys.argv[0])
+    profiling.profiler.start(config('hook-profiling'))
+    start = time.time()
     try:
-        hooks.execute(sys.argv)
+        with profiling.span('hook {}'.format(hook_name)):
+            load_hook_modules(hook_name)
+            hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
+    finally:
+        profiling.profiler.stop(PROFILE_DIR, hook_name)
+        metrics.observe('ci_configurator_hook_duration_seconds',
+                        time.time() - start, hook=hook_name)
+        metrics.flush()
 
 
 if __name__ == '__main__':
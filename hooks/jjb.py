@@ -1,7 +1,11 @@
+import glob
+import hashlib
 import json
 import os
+import re
 import shutil
 import subprocess
+import tempfile
 from six.moves.urllib.error import HTTPError
 import time
 import xml.etree.ElementTree as ET
@@ -9,11 +13,13 @@ import xml.etree.ElementTree as ET
 import common
 
 from charmhelpers.core.hookenv import (
-    charm_dir, config, log, relation_ids, relation_get,
-    related_units, ERROR)
+    charm_dir, config, log, relation_ids, ERROR)
 from charmhelpers.fetch import (
     apt_install, apt_update, filter_installed_packages)
-from charmhelpers.core.host import lsb_release, restart_on_change
+from charmhelpers.core.host import file_hash, lsb_release, restart_on_change
+from cihelpers import metrics
+from cihelpers.profiling import timed
+from cihelpers.state import State
 
 PACKAGES = ['git', 'python-pip']
 CONFIG_DIR = '/etc/jenkins_jobs'
@@ -32,6 +38,14 @@ JENKINS_CONFIG_FILE = '/var/lib/jenkins/config.xml'
 TARBALL = 'jenkins-job-builder.tar.gz'
 LOCAL_PIP_DEPS = 'jenkins-job-builder_reqs'
 LOCAL_JOBS_CONFIG = 'job-configs'
+# jjb-virtualenv: one virtualenv per install source, 'current' links the
+# active one and 'previous' the one it replaced.
+VENV_ROOT = '/opt/jenkins-job-builder'
+VENV_CURRENT = os.path.join(VENV_ROOT, 'current')
+VENV_PREVIOUS = os.path.join(VENV_ROOT, 'previous')
+WHEELHOUSE = os.path.join(VENV_ROOT, 'wheelhouse')
+VENV_BIN_DIR = '/usr/local/bin'
+VENV_COMMANDS = ['jenkins-jobs']
 SLEEP_TIME = 30
 MAX_RETRIES = 10
 
@@ -43,18 +57,78 @@ url=%(jenkins_url)s
 """
 
 
+def _jjb_installed():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        for command in ('jenkins-job-builder', 'jenkins-jobs'):
+            if os.path.isfile(os.path.join(path, command)):
+                return True
+    return False
+
+
+def _git_head(repo):
+    try:
+        output = subprocess.check_output(['git', 'ls-remote', repo, 'HEAD'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').split('\t')[0] or None
+
+
+def _package_version(package):
+    try:
+        return subprocess.check_output(
+            ['dpkg-query', '-W', '-f', '${Version}', package]).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def install_fingerprint(src, tarball):
+    """What jenkins-job-builder would be installed from: the bundled
+    tarball and wheels, the git repository and its HEAD, or the distro
+    package version."""
+    if os.path.isfile(tarball):
+        deps = os.path.join(charm_dir(), 'files', LOCAL_PIP_DEPS)
+        return ('file', file_hash(tarball, 'sha256'), common.dir_hash(deps))
+    elif src.startswith('git://') or src.startswith('https://'):
+        return ('git', src, _git_head(src))
+    elif src == 'distro':
+        return ('distro', _package_version('jenkins-job-builder'))
+    return (src,)
+
+
 def install():
     """
     Install jenkins-job-builder from a archive, remote git repository or a
     locally bundled copy shipped with the charm.  Any locally bundled copy
     overrides 'jjb-install-source' setting.
+
+    Nothing is done if jenkins-job-builder is already installed from the
+    same source.
     """
     if not os.path.isdir(CONFIG_DIR):
         os.mkdir(CONFIG_DIR)
     src = config('jjb-install-source')
     tarball = os.path.join(charm_dir(), 'files', TARBALL)
+    state = State('jjb-install')
+    fingerprint = install_fingerprint(src, tarball)
+    virtualenv = bool(config('jjb-virtualenv')) and \
+        fingerprint[0] in ('file', 'git')
+    # switching jjb-virtualenv reinstalls from the same source
+    mode = ('virtualenv',) if virtualenv else ()
+    if _jjb_installed() and not state.needs_work(*(fingerprint + mode)):
+        log('jenkins-job-builder already installed from %s, skipping.' %
+            state.info.get('source'))
+        return
 
-    if os.path.isfile(tarball):
+    if not virtualenv:
+        _deactivate_virtualenv()
+
+    if virtualenv:
+        log('Installing jenkins-job-builder into a virtualenv.')
+        if fingerprint[0] == 'file':
+            install_virtualenv(fingerprint, tarball=tarball)
+        else:
+            install_virtualenv(fingerprint, repo=src)
+    elif os.path.isfile(tarball):
         log('Installing jenkins-job-builder from bundled file: %s.' % tarball)
         install_from_file(tarball)
     elif src.startswith('git://') or src.startswith('https://'):
@@ -75,6 +149,11 @@ def install():
         log(m, ERROR)
         raise Exception(m)
 
+    # the package version, or git once installed, is only known now
+    fingerprint = install_fingerprint(src, tarball)
+    state.done(*(fingerprint + mode),
+               source=tarball if fingerprint[0] == 'file' else src)
+
 
 def _clean_tmp_dir(tmpdir):
     tmpdir = os.path.join('/tmp', 'jenkins-job-builder')
@@ -85,16 +164,18 @@ def _clean_tmp_dir(tmpdir):
             shutil.rmtree(tmpdir)
 
 
-def install_from_file(tarball):
-    log('*** Installing from local tarball: %s.' % tarball)
+def _extract_tarball(tarball):
     outdir = os.path.join('/tmp', 'jenkins-job-builder')
     _clean_tmp_dir(outdir)
+    cmd = ['tar', 'xfz', tarball]
+    subprocess.check_call(cmd, cwd=os.path.dirname(outdir))
+    return outdir
+
 
+def install_from_file(tarball):
+    log('*** Installing from local tarball: %s.' % tarball)
     apt_install(filter_installed_packages(['python-pip']), fatal=True)
-    os.chdir(os.path.dirname(outdir))
-    cmd = ['tar', 'xfz', tarball]
-    subprocess.check_call(cmd)
-    os.chdir(outdir)
+    os.chdir(_extract_tarball(tarball))
     deps = os.path.join(charm_dir(), 'files', LOCAL_PIP_DEPS)
     cmd = ['pip', 'install', '--no-index',
            '--find-links=file://%s' % deps, '-r', 'requirements.txt']
@@ -112,33 +193,133 @@ def install_from_git(repo):
     subprocess.check_call(cmd)
 
 
+def _switch_link(link, target):
+    """Atomically point symlink link at target."""
+    tmp = link + '.tmp'
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(target, tmp)
+    os.rename(tmp, link)
+
+
+def _activate_virtualenv(venv):
+    """Make venv the current virtualenv, keep the one it replaces as the
+    previous one and remove any older ones."""
+    current = None
+    if os.path.islink(VENV_CURRENT):
+        current = os.path.realpath(VENV_CURRENT)
+    _switch_link(VENV_CURRENT, venv)
+    if current and current != venv:
+        _switch_link(VENV_PREVIOUS, current)
+    for command in VENV_COMMANDS:
+        _switch_link(os.path.join(VENV_BIN_DIR, command),
+                     os.path.join(VENV_CURRENT, 'bin', command))
+
+    for path in glob.glob(os.path.join(VENV_ROOT, 'venv-*')):
+        if path not in (venv, current):
+            log('Removing old jenkins-job-builder virtualenv %s.' % path)
+            shutil.rmtree(path)
+
+
+def _deactivate_virtualenv():
+    """Remove the links to the current virtualenv's commands, so that a
+    system install does not write its scripts through them."""
+    for command in VENV_COMMANDS:
+        path = os.path.join(VENV_BIN_DIR, command)
+        if os.path.islink(path) and \
+                os.readlink(path).startswith(VENV_ROOT + os.sep):
+            log('Removing jenkins-job-builder virtualenv link %s.' % path)
+            os.unlink(path)
+
+
+def install_virtualenv(fingerprint, tarball=None, repo=None):
+    """Install jenkins-job-builder from tarball or git repo into a virtualenv
+    of its own and make it the current one.
+
+    Packages are built into a wheelhouse that is kept between installs, so
+    dependencies are only built once. A virtualenv still kept from an
+    earlier install of the same source is switched to without rebuilding.
+    """
+    name = 'venv-%s' % hashlib.sha256(
+        repr(fingerprint).encode('utf-8')).hexdigest()[:12]
+    venv = os.path.join(VENV_ROOT, name)
+    jenkins_jobs = os.path.join(venv, 'bin', 'jenkins-jobs')
+    if os.path.isfile(jenkins_jobs):
+        log('*** Reusing jenkins-job-builder virtualenv %s.' % venv)
+        _activate_virtualenv(venv)
+        return
+
+    packages = ['python-pip', 'python-virtualenv']
+    if repo:
+        packages.append('git')
+    apt_install(filter_installed_packages(packages), fatal=True)
+    if not os.path.isdir(WHEELHOUSE):
+        os.makedirs(WHEELHOUSE)
+
+    cmd = ['pip', 'wheel', '--wheel-dir', WHEELHOUSE,
+           '--find-links', WHEELHOUSE]
+    if repo:
+        log('*** Building wheels from remote git repository: %s' % repo)
+        cmd += ['git+{}'.format(repo)]
+    else:
+        log('*** Building wheels from local tarball: %s.' % tarball)
+        src = _extract_tarball(tarball)
+        deps = os.path.join(charm_dir(), 'files', LOCAL_PIP_DEPS)
+        cmd += ['--no-index', '--find-links', deps,
+                '-r', os.path.join(src, 'requirements.txt'), src]
+    subprocess.check_call(cmd)
+    # the jenkins-job-builder wheel just built, older ones may be cached
+    wheel = max(glob.glob(os.path.join(WHEELHOUSE,
+                                       'jenkins_job_builder-*.whl')),
+                key=os.path.getmtime)
+
+    if os.path.isdir(venv):
+        shutil.rmtree(venv)
+    subprocess.check_call(['virtualenv', venv])
+    subprocess.check_call([os.path.join(venv, 'bin', 'pip'), 'install',
+                           '--no-index', '--find-links', WHEELHOUSE, wheel])
+    # only switch to a virtualenv that works
+    subprocess.check_call([jenkins_jobs, '--version'])
+    _activate_virtualenv(venv)
+    log('*** Installed jenkins-job-builder into %s.' % venv)
+
+
+def rollback_virtualenv():
+    """Switch back to the previous jenkins-job-builder virtualenv."""
+    if not os.path.islink(VENV_PREVIOUS):
+        raise Exception('No previous jenkins-job-builder virtualenv.')
+    previous = os.path.realpath(VENV_PREVIOUS)
+    log('Rolling back jenkins-job-builder to %s.' % previous)
+    _activate_virtualenv(previous)
+
+
 def write_jjb_config():
     log('*** Writing jenkins-job-builder config: %s.' % JJB_CONFIG)
     jenkins = {}
     admin_user, admin_cred = admin_credentials()
-    for rid in relation_ids('jenkins-configurator'):
-        for unit in related_units(rid):
-            jenkins = {
-                'jenkins_url': relation_get('jenkins_url', rid=rid, unit=unit),
-                'username': admin_user,
-                'password': admin_cred,
-            }
-
-            if (None not in jenkins.values() and
-                    '' not in jenkins.values()):
-                with open(JJB_CONFIG, 'w') as out:
-                    out.write(JJB_CONFIG_TEMPLATE % jenkins)
-                log('*** Wrote jenkins-job-builder config: %s.' % JJB_CONFIG)
-                return True
+    for rid, unit, settings in common.relation_snapshot(
+            'jenkins-configurator'):
+        jenkins = {
+            'jenkins_url': settings.get('jenkins_url'),
+            'username': admin_user,
+            'password': admin_cred,
+        }
+
+        if (None not in jenkins.values() and
+                '' not in jenkins.values()):
+            with open(JJB_CONFIG, 'w') as out:
+                out.write(JJB_CONFIG_TEMPLATE % jenkins)
+            log('*** Wrote jenkins-job-builder config: %s.' % JJB_CONFIG)
+            return True
 
     log('*** Not enough data in principle relation. Not writing config.')
     return False
 
 
 def jenkins_context():
-    for rid in relation_ids('jenkins-configurator'):
-        for unit in related_units(rid):
-            return relation_get(rid=rid, unit=unit)
+    for rid, unit, settings in common.relation_snapshot(
+            'jenkins-configurator'):
+        return settings
 
 
 def config_context():
@@ -170,26 +351,22 @@ def admin_credentials():
     """fetches admin credentials either from charm config or remote jenkins
     service"""
 
-    for rid in relation_ids('jenkins-configurator'):
-        admin_user = None
-        admin_cred = None
-        for unit in related_units(rid):
-            jenkins_admin_user = relation_get('jenkins-admin-user',
-                                              rid=rid, unit=unit)
-            jenkins_token = relation_get('jenkins-token',
-                                         rid=rid, unit=unit)
-            if (jenkins_admin_user and jenkins_token) and '' not in \
-               [jenkins_admin_user, jenkins_token]:
-                log(('Configurating Jenkins credentials '
-                     'from charm configuration.'))
-                return jenkins_admin_user, jenkins_token
-
-            admin_user = relation_get('admin_username', rid=rid, unit=unit)
-            admin_cred = relation_get('admin_password', rid=rid, unit=unit)
-            if (admin_user and admin_cred) and \
-               '' not in [admin_user, admin_cred]:
-                log('Configuring Jenkins credentials from Jenkins relation.')
-                return (admin_user, admin_cred)
+    for rid, unit, settings in common.relation_snapshot(
+            'jenkins-configurator'):
+        jenkins_admin_user = settings.get('jenkins-admin-user')
+        jenkins_token = settings.get('jenkins-token')
+        if (jenkins_admin_user and jenkins_token) and '' not in \
+           [jenkins_admin_user, jenkins_token]:
+            log(('Configurating Jenkins credentials '
+                 'from charm configuration.'))
+            return jenkins_admin_user, jenkins_token
+
+        admin_user = settings.get('admin_username')
+        admin_cred = settings.get('admin_password')
+        if (admin_user and admin_cred) and \
+           '' not in [admin_user, admin_cred]:
+            log('Configuring Jenkins credentials from Jenkins relation.')
+            return (admin_user, admin_cred)
 
     return (None, None)
 
@@ -254,16 +431,9 @@ def _get_jjb_cmd():
         raise
 
 
-def _update_jenkins_jobs():
-    if not write_jjb_config():
-        log('Could not write jenkins-job-builder config, skipping '
-            'jobs update.')
-        return
-    if not os.path.isdir(JOBS_CONFIG_DIR):
-        log('Could not find jobs-config directory at expected location, '
-            'skipping jenkins-jobs update (%s)' % JOBS_CONFIG_DIR, ERROR)
-        return
-
+def _run_update_hook():
+    """Run the update hook of the jobs config repo, which prepares the job
+    definitions in JOBS_CONFIG_DIR from the charm context."""
     save_context()
     # inform hook where to find the context json dump
     os.environ['JJB_CHARM_CONTEXT'] = CHARM_CONTEXT_DUMP
@@ -277,6 +447,19 @@ def _update_jenkins_jobs():
         log('Calling jenkins-job-builder repo update hook: %s.' % hook)
         subprocess.check_call(hook)
 
+
+def _update_jenkins_jobs():
+    if not write_jjb_config():
+        log('Could not write jenkins-job-builder config, skipping '
+            'jobs update.')
+        return
+    if not os.path.isdir(JOBS_CONFIG_DIR):
+        log('Could not find jobs-config directory at expected location, '
+            'skipping jenkins-jobs update (%s)' % JOBS_CONFIG_DIR, ERROR)
+        return
+
+    _run_update_hook()
+
     # call jenkins-jobs to actually update jenkins
     # TODO: Call 'jenkins-job test' to validate configs before updating?
     log('Updating jobs in jenkins.')
@@ -288,7 +471,8 @@ def _update_jenkins_jobs():
             cmd = [_get_jjb_cmd(), 'update', JOBS_CONFIG_DIR]
             # Run as the CI_USER so the cache will be primed with the correct
             # permissions (rather than root:root).
-            common.run_as_user(cmd=cmd, user=common.CI_USER)
+            output = common.run_as_user(cmd=cmd, user=common.CI_USER,
+                                        stderr=subprocess.STDOUT)
         except HTTPError as err:
             if err.code == 503:
                 # sleep for a while, retry
@@ -297,13 +481,71 @@ def _update_jenkins_jobs():
                 continue
             else:
                 log('Error updating jobs, check jjb settings and retry', ERROR)
+                break
         except Exception as e:
             log('Error updating jobs, check jjb settings and retry: %s' %
                 str(e), ERROR)
+            output = getattr(e, 'output', None)
+            if output:
+                log(output.decode('utf-8', 'replace'), ERROR)
             raise
+        output = output.decode('utf-8', 'replace')
+        log(output)
+        _count_jobs(output)
         break
 
 
+def _count_jobs(output):
+    """Record jobs updated and skipped from jenkins-jobs update output."""
+    counts = dict(re.findall(r'Number of jobs (generated|updated):\s+(\d+)',
+                             output))
+    if 'updated' not in counts:
+        return
+    updated = int(counts['updated'])
+    metrics.inc('ci_configurator_jjb_jobs_total', updated, result='updated')
+    if 'generated' in counts:
+        metrics.inc('ci_configurator_jjb_jobs_total',
+                    max(0, int(counts['generated']) - updated),
+                    result='skipped')
+
+
+def job_names():
+    """Names of the jobs jenkins-job-builder generates from JOBS_CONFIG_DIR,
+    or None if they cannot be listed here.
+
+    The update hook is run first, as it is before updating jenkins, so that
+    these are the jobs jenkins would get.
+    """
+    if not os.path.isdir(JOBS_CONFIG_DIR):
+        return None
+    try:
+        jjb_cmd = _get_jjb_cmd()
+    except Exception:
+        return None
+    try:
+        _run_update_hook()
+    except Exception as e:
+        log('Could not run jobs-config update hook: %s' % e, ERROR)
+        return None
+
+    outdir = tempfile.mkdtemp()
+    try:
+        try:
+            subprocess.check_call([jjb_cmd, 'test', '-o', outdir,
+                                   JOBS_CONFIG_DIR])
+        except subprocess.CalledProcessError as e:
+            log('Could not list jenkins jobs: %s' % e, ERROR)
+            return None
+        names = set()
+        for root, dirs, files in os.walk(outdir):
+            for name in files:
+                names.add(os.path.relpath(os.path.join(root, name), outdir))
+        return names
+    finally:
+        shutil.rmtree(outdir)
+
+
+@timed
 def update_jenkins():
     if not relation_ids('jenkins-configurator'):
         return
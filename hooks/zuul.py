@@ -1,12 +1,47 @@
+import hashlib
 import os
+import pickle
+import shutil
+import signal
 import subprocess
 
+import six
+import yaml
+
 import common
 
-from charmhelpers.core.hookenv import log, related_units, relation_ids, INFO
+from charmhelpers.core.hookenv import (
+    charm_dir,
+    log,
+    related_units,
+    relation_ids,
+    ERROR,
+    INFO,
+    WARNING,
+)
+from charmhelpers.core import unitdata
+from charmhelpers.core.host import file_hash
+from cihelpers import metrics
+from cihelpers.profiling import timed
 
 ZUUL_CONFIG_DIR = os.path.join(common.CI_CONFIG_DIR, 'zuul')
 ZUUL_INIT_SCRIPT = "/etc/init.d/zuul"
+ZUUL_PID_FILE = "/var/run/zuul/zuul.pid"
+ZUUL_LAYOUT = "/etc/zuul/layout.yaml"
+# per-project layout fragments merged into the layout, see assemble_layout
+ZUUL_FRAGMENTS_DIR = os.path.join(ZUUL_CONFIG_DIR, 'layout.d')
+ZUUL_ASSEMBLED_LAYOUT = os.path.join(common.CONFIG_DIR, 'zuul-layout.yaml')
+# parsed fragments, in the charm directory as hooks unpickle them as root
+# and CONFIG_DIR is owned by the ci user. See _load_fragments.
+ZUUL_FRAGMENT_CACHE = 'zuul-fragments.pickle'
+# unitdata key of the last validation result, see validate_layout_cached
+VALIDATION_KEY = "zuul.layout_validation"
+# same, for units that cannot check job names
+VALIDATION_KEY_NO_JOBS = "zuul.layout_validation_no_jobs"
+# project keys that are not pipelines
+PROJECT_KEYS = ('name', 'template', 'merge-mode')
+# jobs zuul runs itself rather than in jenkins
+BUILTIN_JOBS = ('noop',)
 
 
 # start and stop services
@@ -26,6 +61,268 @@ def stop_zuul():
         pass
 
 
+def reload_zuul():
+    """Have the running zuul server reconfigure itself from its layout.
+
+    Unlike a restart this keeps the changes queued in its pipelines.
+    Returns False if zuul could not be signalled.
+    """
+    log("*** Reloading zuul layout ***", INFO)
+    try:
+        with open(ZUUL_PID_FILE) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, signal.SIGHUP)
+    except (IOError, OSError, ValueError) as e:
+        log("Could not reload zuul: %s" % e, WARNING)
+        return False
+    return True
+
+
+def _named(layout, section, errors):
+    """Entries of a layout section by name, reporting malformed and
+    duplicate entries in errors."""
+    entries = {}
+    for entry in layout.get(section) or []:
+        if not isinstance(entry, dict) or not entry.get('name'):
+            errors.append('%s: entry without a name: %r' % (section, entry))
+            continue
+        if entry['name'] in entries:
+            errors.append('%s: duplicate %s' % (section, entry['name']))
+        entries[entry['name']] = entry
+    return entries
+
+
+def _format(tree, params):
+    if isinstance(tree, six.string_types):
+        return tree.format(**params)
+    if isinstance(tree, list):
+        return [_format(item, params) for item in tree]
+    if isinstance(tree, dict):
+        return dict((_format(k, params), _format(v, params))
+                    for k, v in tree.items())
+    return tree
+
+
+def _job_names(tree):
+    """Job names in a project pipeline's job tree."""
+    if isinstance(tree, six.string_types):
+        yield tree
+    elif isinstance(tree, list):
+        for item in tree:
+            for job in _job_names(item):
+                yield job
+    elif isinstance(tree, dict):
+        for job, children in tree.items():
+            yield job
+            for child in _job_names(children):
+                yield child
+
+
+def validate_layout(layout, job_names=None):
+    """Check a parsed zuul layout for consistency.
+
+    Projects may only use defined pipelines and project templates, and if
+    job_names is given every job they run has to be one of them.
+
+    :returns: list of error messages, empty if the layout is valid
+    """
+    if not isinstance(layout, dict):
+        return ['layout is not a mapping']
+    errors = []
+    pipelines = _named(layout, 'pipelines', errors)
+    if not pipelines:
+        errors.append('no pipelines defined')
+    for name, pipeline in pipelines.items():
+        if not pipeline.get('manager'):
+            errors.append('pipeline %s: no manager' % name)
+    templates = _named(layout, 'project-templates', errors)
+    _named(layout, 'jobs', errors)
+
+    for name, project in _named(layout, 'projects', errors).items():
+        jobs = {}
+        for key, tree in project.items():
+            if key not in PROJECT_KEYS:
+                jobs.setdefault(key, []).append(tree)
+        for requested in project.get('template') or []:
+            if not isinstance(requested, dict):
+                errors.append('project %s: invalid template entry %r' %
+                              (name, requested))
+                continue
+            template = templates.get(requested.get('name'))
+            if template is None:
+                errors.append('project %s: unknown template %s' %
+                              (name, requested.get('name')))
+                continue
+            params = dict(requested, name=name.split('/')[-1])
+            try:
+                expanded = _format(template, params)
+            except (KeyError, IndexError, ValueError) as e:
+                errors.append('project %s: cannot expand template %s: %s' %
+                              (name, template['name'], e))
+                continue
+            for key, tree in expanded.items():
+                if key != 'name':
+                    jobs.setdefault(key, []).append(tree)
+
+        for pipeline, trees in sorted(jobs.items()):
+            if pipeline not in pipelines:
+                errors.append('project %s: unknown pipeline %s' %
+                              (name, pipeline))
+                continue
+            if job_names is None:
+                continue
+            for job in sorted(set(_job_names(trees))):
+                if job not in job_names and job not in BUILTIN_JOBS:
+                    errors.append('project %s: pipeline %s: unknown job %s' %
+                                  (name, pipeline, job))
+    return errors
+
+
+def validate_layout_cached(layout_path):
+    """validate_layout for a layout file, checking jobs against the jobs
+    jenkins-job-builder generates.
+
+    The result is kept in unitdata keyed by a hash of the layout and the
+    jobs config, so unchanged configs are not validated again. Units without
+    jenkins-job-builder do not check job names; their results are kept under
+    a separate key so they are not reused once it is installed.
+    """
+    # only needed here, so other zuul hooks do not import jjb
+    import jjb
+    check_jobs = jjb._jjb_installed()
+    if check_jobs:
+        cache_key = VALIDATION_KEY
+        key = '%s:%s' % (file_hash(layout_path, 'sha256'),
+                         common.dir_hash(jjb.JOBS_CONFIG_DIR))
+    else:
+        cache_key = VALIDATION_KEY_NO_JOBS
+        key = file_hash(layout_path, 'sha256')
+    kv = unitdata.kv()
+    cached = kv.get(cache_key)
+    if cached and cached['key'] == key:
+        log('Zuul layout unchanged since last validation.')
+        return cached['errors']
+
+    try:
+        with open(layout_path) as f:
+            layout = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as e:
+        errors = ['cannot load %s: %s' % (layout_path, e)]
+    else:
+        job_names = jjb.job_names() if check_jobs else None
+        errors = validate_layout(layout, job_names)
+        if check_jobs and job_names is None:
+            # try again next time rather than remember a partial check
+            log('Jenkins jobs not available, not checking zuul job names.',
+                WARNING)
+            return errors
+
+    kv.set(cache_key, {'key': key, 'errors': errors})
+    kv.flush()
+    return errors
+
+
+def _load_fragments(paths, cache_path):
+    """Parsed YAML of paths ({name: path}).
+
+    Parsed fragments are kept in cache_path keyed by the hash of their
+    content, so only fragments that changed since the last run are parsed.
+    They are pickled rather than dumped as JSON so that a cached fragment
+    keeps the YAML types (integer keys, dates, ...) of a freshly parsed one,
+    so cache_path must not be writable by anyone but the hook's user.
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+    except Exception:
+        # missing, truncated or written by another python version
+        cache = {}
+
+    fragments = {}
+    entries = {}
+    dirty = set(cache) - set(paths)
+    for name, path in paths.items():
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        entry = cache.get(name)
+        if not entry or entry['hash'] != digest:
+            with open(path) as f:
+                entry = {'hash': digest, 'layout': yaml.safe_load(f)}
+            dirty.add(name)
+        fragments[name] = entry['layout']
+        entries[name] = entry
+
+    if dirty:
+        tmp = cache_path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entries, f, protocol=2)
+            os.rename(tmp, cache_path)
+        except Exception as e:
+            log('Could not cache zuul layout fragments: %s' % e, WARNING)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    return fragments
+
+
+def assemble_layout(base_path, fragments_dir, cache_path):
+    """Merge the layout at base_path (if any) with the *.yaml fragments in
+    fragments_dir.
+
+    Sections of the fragments (pipelines, projects, ...) are appended to
+    those of the base layout in file name order. Defining the same name in
+    two places is an error rather than an override, so teams owning
+    different fragments cannot silently clobber each other.
+
+    :returns: (layout, errors)
+    """
+    paths = {}
+    if os.path.isfile(base_path):
+        paths[os.path.basename(base_path)] = base_path
+    for name in os.listdir(fragments_dir):
+        if name.endswith('.yaml'):
+            paths[os.path.join(os.path.basename(fragments_dir), name)] = \
+                os.path.join(fragments_dir, name)
+
+    errors = []
+    try:
+        fragments = _load_fragments(paths, cache_path)
+    except (IOError, yaml.YAMLError) as e:
+        return None, ['cannot load layout fragments: %s' % e]
+
+    layout = {}
+    origins = {}
+    order = sorted(fragments, key=lambda name: (paths[name] != base_path,
+                                                name))
+    for name in order:
+        fragment = fragments[name] or {}
+        if not isinstance(fragment, dict):
+            errors.append('%s: not a mapping' % name)
+            continue
+        for section, value in fragment.items():
+            if not isinstance(value, list):
+                if section in layout and layout[section] != value:
+                    errors.append('%s: %s conflicts with %s' %
+                                  (name, section, origins[section]))
+                layout[section] = value
+                origins[section] = name
+                continue
+            merged = layout.setdefault(section, [])
+            for entry in value:
+                if isinstance(entry, dict) and entry.get('name'):
+                    key = (section, entry['name'])
+                    if key in origins:
+                        errors.append('%s: %s %s already defined in %s' %
+                                      (name, section, entry['name'],
+                                       origins[key]))
+                        continue
+                    origins[key] = name
+                merged.append(entry)
+    return layout, errors
+
+
+@timed
 def update_zuul():
     zuul_units = []
 
@@ -37,17 +334,45 @@ def update_zuul():
         return
 
     log("*** Updating zuul.")
-    layout_path = '/etc/zuul/layout.yaml'
+    layout_path = ZUUL_LAYOUT
 
     if not os.path.isdir(ZUUL_CONFIG_DIR):
         log('Could not find zuul config directory at expected location, '
             'skipping zuul update (%s)' % ZUUL_CONFIG_DIR)
         return
 
-    log('Installing layout from %s to %s.' % (ZUUL_CONFIG_DIR, layout_path))
-    common.sync_dir(ZUUL_CONFIG_DIR, layout_path)
+    source = os.path.join(ZUUL_CONFIG_DIR, 'layout.yaml')
+    fragments = os.path.isdir(ZUUL_FRAGMENTS_DIR)
+    if fragments:
+        log('Assembling layout from %s.' % ZUUL_FRAGMENTS_DIR)
+        layout, errors = assemble_layout(
+            source, ZUUL_FRAGMENTS_DIR,
+            os.path.join(charm_dir(), ZUUL_FRAGMENT_CACHE))
+        if not errors:
+            source = ZUUL_ASSEMBLED_LAYOUT
+            with open(source, 'w') as f:
+                yaml.safe_dump(layout, f, default_flow_style=False)
+            errors = validate_layout_cached(source)
+    else:
+        errors = validate_layout_cached(source)
+    if errors:
+        for error in errors:
+            log('Invalid zuul layout: %s' % error, ERROR)
+        log('Not installing invalid zuul layout %s.' % source, ERROR)
+        return False
+
+    log('Installing layout from %s to %s.' % (source, layout_path))
+    old_hash = file_hash(layout_path)
+    shutil.copy(source, layout_path)
+    if file_hash(layout_path) == old_hash:
+        log('Zuul layout unchanged, not reloading.')
+        return True
 
-    stop_zuul()
-    start_zuul()
+    if reload_zuul():
+        metrics.inc('ci_configurator_reloads_total', service='zuul')
+    else:
+        metrics.inc('ci_configurator_restarts_total', service='zuul')
+        stop_zuul()
+        start_zuul()
 
     return True
@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+# Measure how long each hook takes to start: importing hooks.py and the
+# modules it loads for that hook, before any hook code runs.
+#
+# Usage: bench_hook_startup.py [runs]
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+HOOKS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                         'hooks'))
+STARTUP = """
+import sys
+import time
+start = time.time()
+sys.path.insert(0, %(hooks_dir)r)
+import hooks
+hooks.load_hook_modules(%(hook)r)
+print(time.time() - start)
+"""
+
+
+def hook_names():
+    return sorted(name for name in os.listdir(HOOKS_DIR)
+                  if os.path.islink(os.path.join(HOOKS_DIR, name)))
+
+
+def startup_time(hook):
+    code = STARTUP % {'hooks_dir': HOOKS_DIR, 'hook': hook}
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return float(output.decode('utf-8').split()[-1])
+
+
+def main(runs=5):
+    print('%-40s %8s %8s' % ('hook', 'min', 'median'))
+    for hook in hook_names():
+        times = sorted(startup_time(hook) for _ in range(runs))
+        print('%-40s %7.3fs %7.3fs' % (hook, times[0], times[len(times) // 2]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,18 @@
+import os
+import shutil
+import tempfile
+
+from charmhelpers.core import unitdata
+
+
+def use_temp_unitdata(test):
+    """Point unitdata.kv() at an empty database for the duration of test.
+
+    :returns: the Storage unitdata.kv() returns
+    """
+    tmpdir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmpdir)
+    kv = unitdata.Storage(os.path.join(tmpdir, 'state.db'))
+    test.addCleanup(kv.close)
+    test.patch(unitdata, 'kv', lambda: kv)
+    return kv
@@ -0,0 +1,36 @@
+import mock
+import testtools
+
+import common
+
+
+class RelationSnapshotTestCase(testtools.TestCase):
+
+    def test_relation_snapshot(self):
+        self.patch(common, 'relation_ids', mock.Mock(return_value=['rel:1']))
+        self.patch(common, 'related_units',
+                   mock.Mock(return_value=['jenkins/0', 'jenkins/1']))
+        settings = {'jenkins/0': {'jenkins_url': 'http://jenkins'},
+                    'jenkins/1': None}
+        relation_get = mock.Mock(
+            side_effect=lambda rid, unit: settings[unit])
+        self.patch(common, 'relation_get', relation_get)
+        self.assertEqual(
+            [('rel:1', 'jenkins/0', {'jenkins_url': 'http://jenkins'}),
+             ('rel:1', 'jenkins/1', {})],
+            common.relation_snapshot('jenkins-configurator'))
+        self.assertEqual(2, relation_get.call_count)
+
+
+class IsPinnedTestCase(testtools.TestCase):
+
+    def test_bzr(self):
+        for revision in ('123', '1.2.3', 'revno:42', 'revid:a@b-2016'):
+            self.assertTrue(common._is_pinned('bzr', revision), revision)
+        for revision in (None, '', 'trunk', 'last:1', '-1', 'tag:1.0',
+                         'date:yesterday', 'branch:lp:foo'):
+            self.assertFalse(common._is_pinned('bzr', revision), revision)
+
+    def test_git(self):
+        self.assertTrue(common._is_pinned('git', 'a' * 40))
+        self.assertFalse(common._is_pinned('git', 'master'))
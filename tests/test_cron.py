@@ -0,0 +1,76 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import testtools
+
+from cihelpers import cron
+
+
+class RunCoordinatorTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(RunCoordinatorTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.lock_path = os.path.join(self.tmpdir, 'job.lock')
+        self.coordinator = cron.RunCoordinator(self.lock_path)
+
+    def test_run_records_state(self):
+        self.assertEqual((True, 0), self.coordinator.run(lambda: 0))
+        state = self.coordinator.state()
+        self.assertEqual('ok', state['status'])
+        self.assertEqual(state['last_end'] - state['last_start'],
+                         state['last_duration'])
+
+        self.assertEqual((True, 1), self.coordinator.run(lambda: 1))
+        self.assertEqual('failed', self.coordinator.state()['status'])
+
+    def test_run_failure_is_recorded(self):
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, self.coordinator.run, fail)
+        self.assertEqual('failed', self.coordinator.state()['status'])
+
+    def test_run_skipped_while_locked(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            func = mock.Mock()
+            ran, reason = cron.RunCoordinator(self.lock_path).run(func)
+        self.assertFalse(ran)
+        self.assertEqual('previous run still in progress', reason)
+        self.assertFalse(func.called)
+
+    def test_run_reports_stuck_run(self):
+        self.patch(cron, 'log', mock.Mock())
+        inc = mock.Mock()
+        self.patch(cron.metrics, 'inc', inc)
+        now = time.time()
+        self.coordinator._save_state({'last_start': now - 2 * 60 * 60,
+                                      'last_end': now - 3 * 60 * 60,
+                                      'last_duration': 600,
+                                      'status': 'running'})
+        self.assertEqual(0, self.coordinator.stuck(now - 90 * 60))
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            ran, reason = self.coordinator.run(mock.Mock())
+        self.assertFalse(ran)
+        self.assertEqual('ERROR', cron.log.call_args[0][1])
+        inc.assert_called_once_with('ci_configurator_cron_stuck_total',
+                                    job='job.lock')
+
+    def test_run_skipped_during_cooldown(self):
+        now = time.time()
+        self.coordinator._save_state({'last_start': now - 1000,
+                                      'last_end': now - 100,
+                                      'last_duration': 900,
+                                      'status': 'ok'})
+        func = mock.Mock()
+        ran, reason = self.coordinator.run(func)
+        self.assertFalse(ran)
+        self.assertFalse(func.called)
+        self.assertEqual(0, self.coordinator.cooldown(now + 350))
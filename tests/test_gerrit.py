@@ -4,6 +4,7 @@ import testtools
 import tempfile
 import shutil
 import gerrit
+from helpers import use_temp_unitdata
 
 LS_REMOTE_OUTPUT_NO_BRANCHES = """
 3bd6f626873b11b27624769554ec5fbebe48a056    HEAD
@@ -142,3 +143,31 @@ class GerritTestCase(testtools.TestCase):
         mock_run_as_user.return_value = \
             "Initial permissions\nInitial permissions\n"
         self.assertTrue(gerrit.is_permissions_initialised('foo', 'bar'))
+
+
+class UpdateHooksTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(UpdateHooksTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        use_temp_unitdata(self)
+        self.patch(gerrit, 'log', mock.Mock())
+        self.hooks_dir = os.path.join(self.tmpdir, 'hooks')
+        os.mkdir(self.hooks_dir)
+        with open(os.path.join(self.hooks_dir, 'patchset-created'), 'w') as f:
+            f.write('notify {{url}}\n')
+        self.patch(gerrit, 'HOOKS_DIR', self.hooks_dir)
+        self.dest = os.path.join(self.tmpdir, 'site-hooks')
+        os.mkdir(self.dest)
+
+    def test_reinstalled_when_wiped(self):
+        settings = {'url': 'http://ci'}
+        self.assertTrue(gerrit.update_hooks(self.dest, settings))
+        self.assertFalse(gerrit.update_hooks(self.dest, settings))
+        shutil.rmtree(self.dest)
+        os.mkdir(self.dest)
+        self.assertTrue(gerrit.update_hooks(self.dest, settings))
+        with open(os.path.join(self.dest, 'patchset-created')) as f:
+            self.assertEqual('notify http://ci\n', f.read())
+        self.assertTrue(gerrit.update_hooks(self.dest, {'url': 'http://x'}))
@@ -0,0 +1,270 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from cihelpers import gerrit as gerrit_client
+
+
+def gsql_rows(*rows):
+    lines = [json.dumps({'type': 'row', 'columns': row}) for row in rows]
+    lines.append(json.dumps({'type': 'query-stats', 'rowCount': len(rows)}))
+    return '\n'.join(lines)
+
+
+class FakeGerrit(object):
+    """Answers gsql SELECTs from canned rows and records every command."""
+
+    def __init__(self, account_ids=None, ssh_keys=None, external_ids=None):
+        self.account_ids = account_ids or {}
+        self.ssh_keys = ssh_keys or []
+        self.external_ids = external_ids or []
+        self.cmds = []
+
+    def __call__(self, cmd):
+        self.cmds.append(cmd)
+        if 'FROM account_external_ids WHERE external_id IN' in cmd:
+            rows = [{'account_id': account_id,
+                     'external_id': 'username:%s' % login}
+                    for login, account_id in self.account_ids.items()
+                    if "'username:%s'" % login in cmd]
+            return gsql_rows(*rows), ''
+        if 'SELECT account_id, ssh_public_key, seq' in cmd:
+            return gsql_rows(*self.ssh_keys), ''
+        if 'SELECT account_id, external_id' in cmd:
+            return gsql_rows(*self.external_ids), ''
+        return '', ''
+
+    def writes(self):
+        return [cmd for cmd in self.cmds
+                if 'SELECT' not in cmd and 'flush-caches' not in cmd]
+
+
+class ImportTestCase(testtools.TestCase):
+
+    def test_paramiko_imported_on_first_connection(self):
+        self.assertNotIn('paramiko', vars(gerrit_client))
+        paramiko = mock.Mock()
+        self.patch(gerrit_client, '_connection', None)
+        self.patch(gerrit_client, '_paramiko', paramiko)
+        ssh = gerrit_client.get_ssh('localhost', 'admin', 29418, '/tmp/key')
+        self.assertIs(paramiko.SSHClient.return_value, ssh)
+        ssh.connect.assert_called_once_with('localhost', username='admin',
+                                            port=29418,
+                                            key_filename='/tmp/key')
+
+
+class AccountIdCacheTestCase(testtools.TestCase):
+
+    def test_persisted(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'account-ids.json')
+        cache = gerrit_client.AccountIdCache(path)
+        cache.update({'alice': '1000', 'bob': '1001'})
+        cache.invalidate(['bob'])
+        self.assertFalse(os.path.exists(path))
+        cache.save()
+        cache = gerrit_client.AccountIdCache(path)
+        self.assertEqual(('1000', None), (cache.get('alice'),
+                                          cache.get('bob')))
+        self.assertFalse(cache.expired('alice'))
+        self.assertTrue(cache.expired('bob'))
+
+
+class GerritClientTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(GerritClientTestCase, self).setUp()
+        self.patch(gerrit_client, 'get_ssh', mock.MagicMock())
+        self.patch(gerrit_client, 'log', mock.MagicMock())
+        self.account_ids = gerrit_client.AccountIdCache()
+        self.client = gerrit_client.GerritClient('localhost', 'admin', 29418,
+                                                 '/tmp/key',
+                                                 account_ids=self.account_ids)
+
+    def _run(self, fake, users):
+        self.patch(self.client, '_run_cmd', fake)
+        return self.client.create_users_batch('devs', users)
+
+    def test_create_users_batch_existing_unchanged(self):
+        fake = FakeGerrit(
+            account_ids={'alice': '1000', 'bob': '1001'},
+            ssh_keys=[{'account_id': '1000', 'ssh_public_key': 'ssh-rsa A',
+                       'seq': '1'}],
+            external_ids=[{'account_id': '1000',
+                           'external_id': 'https://login.ubuntu.com/+id/a'}])
+        self._run(fake, [
+            ('alice', 'Alice', 'alice@example.com', ('ssh-rsa A',),
+             'https://login.launchpad.net/+id/a'),
+            ('bob', 'Bob', 'bob@example.com', (), None),
+        ])
+        self.assertEqual(['gerrit set-members "devs" --add alice --add bob'],
+                         fake.writes())
+        self.assertEqual(4, len(fake.cmds))
+
+    def test_create_users_batch_set_based_writes(self):
+        fake = FakeGerrit(
+            account_ids={'alice': '1000', 'bob': '1001'},
+            ssh_keys=[{'account_id': '1000', 'ssh_public_key': 'ssh-rsa old',
+                       'seq': '2'},
+                      {'account_id': '1001', 'ssh_public_key': 'ssh-rsa B',
+                       'seq': '1'}],
+            external_ids=[{'account_id': '1001',
+                           'external_id': 'https://login.ubuntu.com/+id/x'}])
+        self._run(fake, [
+            ('alice', 'Alice', 'alice@example.com', ('ssh-rsa A',),
+             None),
+            ('bob', 'Bob', 'bob@example.com', ('ssh-rsa B', 'ssh-rsa C'),
+             'https://login.launchpad.net/+id/b'),
+        ])
+        writes = fake.writes()[1:]
+        self.assertEqual(4, len(writes))
+        self.assertIn('DELETE FROM account_ssh_keys WHERE '
+                      '(account_id=1000 AND seq IN (2))', writes[0])
+        self.assertIn("('ssh-rsa A', 'Y', 1000, 3)", writes[1])
+        self.assertIn("('ssh-rsa C', 'Y', 1001, 2)", writes[1])
+        self.assertIn("external_id IN ('https://login.ubuntu.com/+id/x')",
+                      writes[2])
+        self.assertIn("(1001, 'bob@example.com', "
+                      "'https://login.ubuntu.com/+id/b')", writes[3])
+
+    def test_create_users_batch_new_account(self):
+        fake = FakeGerrit()
+
+        def create_account(cmd):
+            if cmd.startswith('gerrit create-account carol'):
+                fake.account_ids['carol'] = '1002'
+            return fake(cmd)
+
+        self._run(create_account, [
+            ('carol', 'Carol', 'carol@example.com', ('ssh-rsa C',), None),
+        ])
+        self.assertEqual('gerrit create-account carol --full-name "Carol" '
+                         '--group "devs" --email "carol@example.com"',
+                         fake.cmds[1])
+        self.assertIn("('ssh-rsa C', 'Y', 1002, 1)", fake.writes()[-1])
+
+    def test_create_users_batch_returns_failed(self):
+        fake = FakeGerrit(account_ids={'alice': '1000'})
+
+        def create_account(cmd):
+            if cmd.startswith('gerrit create-account carol'):
+                fake.cmds.append(cmd)
+                return '', 'error: invalid email'
+            return fake(cmd)
+
+        changed, failed = self._run(create_account, [
+            ('alice', 'Alice', 'a@example.com', (), None),
+            ('bob', 'Bob', 'b@example.com', (), None),
+            ('carol', 'Carol', 'c@example', (), None)])
+        self.assertEqual(['carol', 'bob'], failed)
+        self.assertNotIn('username:carol', self._lookups(fake)[-1])
+
+    def test_create_users_batch_fatal_error(self):
+        fake = FakeGerrit()
+
+        def create_account(cmd):
+            if cmd.startswith('gerrit create-account'):
+                return '', 'fatal: connection lost'
+            return fake(cmd)
+
+        self.assertRaises(gerrit_client.GerritException, self._run,
+                          create_account,
+                          [('carol', 'Carol', 'c@example.com', (), None)])
+
+    def test_create_users_batch_chunks(self):
+        self.patch(gerrit_client, 'GSQL_BATCH_SIZE', 2)
+        fake = FakeGerrit(account_ids=dict(('u%d' % i, str(1000 + i))
+                                           for i in range(5)))
+        self._run(fake, [('u%d' % i, 'U', 'u@example.com', (), None)
+                         for i in range(5)])
+        lookups = [cmd for cmd in fake.cmds
+                   if 'WHERE external_id IN' in cmd]
+        self.assertEqual(3, len(lookups))
+
+    def _lookups(self, fake):
+        return [cmd for cmd in fake.cmds if 'WHERE external_id IN' in cmd]
+
+    def test_create_users_batch_cached_account_ids(self):
+        self.account_ids.update({'alice': '1000', 'bob': '1001'})
+        fake = FakeGerrit(account_ids={'alice': '1000', 'bob': '1001'})
+        self._run(fake, [('alice', 'Alice', 'a@example.com', (), None),
+                         ('bob', 'Bob', 'b@example.com', (), None)])
+        self.assertEqual([], self._lookups(fake))
+
+    def test_create_users_batch_rechecks_cached_account_ids(self):
+        self.account_ids.update({'alice': '999', 'carol': '1002'})
+        fake = FakeGerrit(account_ids={'alice': '1000', 'bob': '1001'})
+        self._run(fake, [('alice', 'Alice', 'a@example.com', (), None),
+                         ('bob', 'Bob', 'b@example.com', (), None),
+                         ('carol', 'Carol', 'c@example.com', (), None)])
+        self.assertIn("'username:alice'", self._lookups(fake)[0])
+        self.assertEqual('1000', self.account_ids.get('alice'))
+        self.assertEqual('1001', self.account_ids.get('bob'))
+        self.assertIsNone(self.account_ids.get('carol'))
+
+    def test_create_users_batch_expired_account_ids(self):
+        self.account_ids.update({'alice': '1000'})
+        self.patch(gerrit_client.AccountIdCache, 'MAX_AGE', -1)
+        fake = FakeGerrit(account_ids={'alice': '1000'})
+        self._run(fake, [('alice', 'Alice', 'a@example.com', (), None)])
+        self.assertEqual(1, len(self._lookups(fake)))
+
+    def test_create_users_batch_error_invalidates_cache(self):
+        self.account_ids.update({'alice': '1000'})
+        fake = FakeGerrit(account_ids={'alice': '1000'},
+                          ssh_keys=[{'account_id': '1000',
+                                     'ssh_public_key': 'ssh-rsa old',
+                                     'seq': '1'}])
+
+        def failing_delete(cmd):
+            if cmd.startswith('gerrit gsql -c "DELETE'):
+                fake.cmds.append(cmd)
+                return '', 'fatal: database error'
+            return fake(cmd)
+
+        self.assertRaises(gerrit_client.GerritException, self._run,
+                          failing_delete,
+                          [('alice', 'Alice', 'a@example.com', (), None)])
+        self.assertIsNone(self.account_ids.get('alice'))
+
+    def test_create_users_batch_flushes_account_caches_once(self):
+        self.patch(gerrit_client, 'GSQL_BATCH_SIZE', 1)
+        fake = FakeGerrit(account_ids={'alice': '1000', 'bob': '1001'})
+        self._run(fake, [('alice', 'Alice', 'a@example.com', ('ssh-rsa A',),
+                          None),
+                         ('bob', 'Bob', 'b@example.com', ('ssh-rsa B',),
+                          None)])
+        flushes = [cmd for cmd in fake.cmds if 'flush-caches' in cmd]
+        self.assertEqual(['gerrit flush-caches --cache accounts '
+                          '--cache accounts_byemail --cache accounts_byname '
+                          '--cache sshkeys'], flushes)
+
+    def test_create_users_batch_no_changes_no_flush(self):
+        fake = FakeGerrit(account_ids={'alice': '1000'})
+        self._run(fake, [('alice', 'Alice', 'a@example.com', (), None)])
+        self.assertEqual([], [cmd for cmd in fake.cmds
+                              if 'flush-caches' in cmd])
+
+    def test_flush_cache_falls_back_to_all(self):
+        cmds = []
+
+        def run_cmd(cmd):
+            cmds.append(cmd)
+            if '--cache accounts_byname' in cmd:
+                return '', 'fatal: "accounts_byname" is not a valid cache'
+            return '', ''
+        self.patch(self.client, '_run_cmd', run_cmd)
+        self.client.flush_cache(['accounts', 'accounts_byname'])
+        self.assertEqual('gerrit flush-caches --all', cmds[-1])
+
+    def test_flush_cache_error(self):
+        self.patch(self.client, '_run_cmd',
+                   mock.Mock(return_value=('', 'fatal: not permitted')))
+        self.assertRaises(gerrit_client.GerritException,
+                          self.client.flush_cache,
+                          gerrit_client.ACCOUNT_CACHES)
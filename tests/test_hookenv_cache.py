@@ -0,0 +1,34 @@
+import mock
+import testtools
+
+from charmhelpers.core import hookenv
+
+
+class CachedTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(CachedTestCase, self).setUp()
+        self.patch(hookenv, 'cache', hookenv.Cache())
+        self.func = mock.Mock(side_effect=lambda *args, **kwargs: object())
+        self.func.__name__ = 'unit_get'
+        self.cached = hookenv.cached(self.func)
+
+    def test_cached(self):
+        value = self.cached('private-address', unit='app/0')
+        self.assertIs(value, self.cached('private-address', unit='app/0'))
+        self.assertIsNot(value, self.cached('private-address', unit='app/1'))
+        self.assertEqual(2, self.func.call_count)
+        self.assertEqual((1, 2), (hookenv.cache.hits, hookenv.cache.misses))
+
+    def test_unhashable_arguments(self):
+        value = self.cached(['a'])
+        self.assertIs(value, self.cached(['a']))
+
+    def test_flush(self):
+        app0 = self.cached('address', unit='app/0')
+        app1 = self.cached('address', unit='app/1')
+        hookenv.flush('app/0')
+        self.assertIsNot(app0, self.cached('address', unit='app/0'))
+        self.assertIs(app1, self.cached('address', unit='app/1'))
+        hookenv.flush('unit_get')
+        self.assertIsNot(app1, self.cached('address', unit='app/1'))
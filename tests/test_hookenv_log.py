@@ -0,0 +1,37 @@
+import mock
+import testtools
+
+from charmhelpers.core import hookenv
+
+
+class LogBufferTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(LogBufferTestCase, self).setUp()
+        self.juju_log = mock.Mock()
+        self.patch(hookenv, '_juju_log', self.juju_log)
+
+    def test_unbuffered(self):
+        self.patch(hookenv, '_log_buffer', None)
+        hookenv.log('one')
+        hookenv.log('two', hookenv.ERROR)
+        self.assertEqual([mock.call('one', None),
+                          mock.call('two', hookenv.ERROR)],
+                         self.juju_log.call_args_list)
+
+    def test_flush_on_level_change(self):
+        self.patch(hookenv, '_log_buffer', hookenv.LogBuffer())
+        hookenv.log('one')
+        hookenv.log('two')
+        self.assertFalse(self.juju_log.called)
+        hookenv.log('three', hookenv.ERROR)
+        self.juju_log.assert_called_once_with('one\ntwo', None)
+        hookenv.flush_logs()
+        self.juju_log.assert_called_with('three', hookenv.ERROR)
+
+    def test_flush_on_size(self):
+        self.patch(hookenv, '_log_buffer', hookenv.LogBuffer(max_size=6))
+        hookenv.log('one')
+        hookenv.log('two')
+        hookenv.log('three')
+        self.juju_log.assert_called_once_with('one\ntwo', None)
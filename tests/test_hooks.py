@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import testtools
+
+import hooks
+
+HOOKS_DIR = os.path.dirname(os.path.abspath(hooks.__file__))
+
+
+class HookModulesTestCase(testtools.TestCase):
+
+    def test_every_hook_has_modules(self):
+        names = [name for name in os.listdir(HOOKS_DIR)
+                 if os.path.islink(os.path.join(HOOKS_DIR, name))]
+        self.assertEqual(sorted(names), sorted(hooks.HOOK_MODULES))
+
+    def test_load_hook_modules(self):
+        self.patch(hooks, 'zuul', None)
+        self.patch(hooks, 'jjb', None)
+        hooks.load_hook_modules('zuul-configurator-relation-changed')
+        self.assertEqual('zuul', hooks.zuul.__name__)
+        self.assertIsNone(hooks.jjb)
+
+    def _imported(self, hook):
+        code = ('import sys; import hooks; hooks.load_hook_modules(%r); '
+                'print(" ".join(sys.modules))' % hook)
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=HOOKS_DIR)
+        return set(output.decode('utf-8').split())
+
+    def test_short_hooks_skip_slow_imports(self):
+        slow = set(['yaml', 'jjb', 'zuul', 'gerrit', 'sqlite3', 'distutils',
+                    'xml.etree.ElementTree'])
+        self.assertEqual(set(), self._imported('vault-relation-joined') & slow)
+        self.assertNotIn('jjb', self._imported(
+            'zuul-configurator-relation-changed'))
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import testtools
+
+from charmhelpers.core import host
+
+
+class FileHashTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(FileHashTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(host, '_hash_cache', {})
+        self.patch(host, 'HASH_CHUNK_SIZE', 7)
+        self.path = os.path.join(self.tmpdir, 'app.war')
+
+    def _write(self, content, age=60):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+        mtime = time.time() - age
+        os.utime(self.path, (mtime, mtime))
+
+    def _ctime_aged(self):
+        # ctime cannot be set, treat the file as old instead
+        self.patch(host, 'HASH_CACHE_MIN_AGE', -60)
+
+    def test_chunked_hash(self):
+        content = b'x' * 100 + b'y'
+        self._write(content)
+        self.assertEqual(hashlib.sha256(content).hexdigest(),
+                         host.file_hash(self.path, 'sha256'))
+        self.assertIsNone(host.file_hash(self.path + '.missing'))
+
+    def test_unchanged_file_not_read_again(self):
+        self._ctime_aged()
+        self._write(b'content')
+        digest = host.file_hash(self.path)
+        self.patch(host, 'open', mock.Mock(side_effect=AssertionError))
+        self.assertEqual(digest, host.file_hash(self.path))
+        self.assertEqual({self.path: digest},
+                         host.path_hash(os.path.join(self.tmpdir, '*')))
+
+    def test_changed_file_read_again(self):
+        self._ctime_aged()
+        self._write(b'port 8080')
+        digest = host.file_hash(self.path)
+        self._write(b'port 8081', age=30)
+        self.assertNotEqual(digest, host.file_hash(self.path))
+
+    def test_recently_modified_file_not_cached(self):
+        self._write(b'content', age=0)
+        host.file_hash(self.path)
+        self.assertEqual({}, host._hash_cache)
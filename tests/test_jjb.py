@@ -0,0 +1,218 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import mock
+import testtools
+
+import jjb
+from helpers import use_temp_unitdata
+
+
+class InstallTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(InstallTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        use_temp_unitdata(self)
+        self.patch(jjb, 'CONFIG_DIR', self.tmpdir)
+        self.patch(jjb, 'log', mock.Mock())
+        self.patch(jjb, 'charm_dir', mock.Mock(return_value=self.tmpdir))
+        self.config = {'jjb-install-source': 'https://example.com/jjb.git'}
+        self.patch(jjb, 'config', self.config.get)
+        self.patch(jjb, '_jjb_installed', mock.Mock(return_value=True))
+        self.git_head = mock.Mock(return_value='abc')
+        self.patch(jjb, '_git_head', self.git_head)
+        self.install_from_git = mock.Mock()
+        self.patch(jjb, 'install_from_git', self.install_from_git)
+
+    def test_install_skipped_when_unchanged(self):
+        jjb.install()
+        jjb.install()
+        self.install_from_git.assert_called_once_with(
+            'https://example.com/jjb.git')
+
+        self.git_head.return_value = 'def'
+        jjb.install()
+        self.assertEqual(2, self.install_from_git.call_count)
+
+    def test_install_when_missing(self):
+        jjb.install()
+        jjb._jjb_installed.return_value = False
+        jjb.install()
+        self.assertEqual(2, self.install_from_git.call_count)
+
+    def test_install_when_virtualenv_toggled(self):
+        install_virtualenv = mock.Mock()
+        self.patch(jjb, 'install_virtualenv', install_virtualenv)
+        self.patch(jjb, '_deactivate_virtualenv', mock.Mock())
+        jjb.install()
+        self.config['jjb-virtualenv'] = True
+        jjb.install()
+        jjb.install()
+        install_virtualenv.assert_called_once_with(
+            ('git', 'https://example.com/jjb.git', 'abc'),
+            repo='https://example.com/jjb.git')
+
+        self.config['jjb-virtualenv'] = False
+        jjb.install()
+        self.assertEqual(2, self.install_from_git.call_count)
+        self.assertEqual(2, jjb._deactivate_virtualenv.call_count)
+
+    def test_install_from_file_fingerprint(self):
+        tarball = os.path.join(self.tmpdir, 'files', jjb.TARBALL)
+        os.mkdir(os.path.dirname(tarball))
+        with open(tarball, 'w') as f:
+            f.write('v1')
+        install_from_file = mock.Mock()
+        self.patch(jjb, 'install_from_file', install_from_file)
+        jjb.install()
+        jjb.install()
+        with open(tarball, 'w') as f:
+            f.write('v2')
+        jjb.install()
+        self.assertEqual(2, install_from_file.call_count)
+
+
+class UpdateJobsTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(UpdateJobsTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(jjb, 'JOBS_CONFIG_DIR', self.tmpdir)
+        self.patch(jjb, 'write_jjb_config', mock.Mock(return_value=True))
+        self.patch(jjb, 'save_context', mock.Mock())
+        self.patch(jjb, '_get_jjb_cmd', mock.Mock(return_value='jenkins-jobs'))
+        self.patch(jjb, 'log', mock.Mock())
+        self.run_as_user = mock.Mock()
+        self.patch(jjb.common, 'run_as_user', self.run_as_user)
+        self.patch(os, 'environ', dict(os.environ))
+
+    def test_output_logged(self):
+        self.run_as_user.return_value = b'Number of jobs updated: 2\n'
+        jjb._update_jenkins_jobs()
+        jjb.log.assert_called_with('Number of jobs updated: 2\n')
+
+    def test_failure_output_logged(self):
+        self.run_as_user.side_effect = subprocess.CalledProcessError(
+            1, 'jenkins-jobs', output=b'Unknown macro foo')
+        self.assertRaises(subprocess.CalledProcessError,
+                          jjb._update_jenkins_jobs)
+        jjb.log.assert_called_with('Unknown macro foo', jjb.ERROR)
+
+    def test_http_error_stops_retrying(self):
+        self.run_as_user.side_effect = jjb.HTTPError(
+            'http://jenkins', 500, 'error', {}, None)
+        jjb._update_jenkins_jobs()
+        self.assertEqual(1, self.run_as_user.call_count)
+
+    def test_job_names_runs_update_hook(self):
+        hook = os.path.join(self.tmpdir, 'update')
+        open(hook, 'w').close()
+        check_call = mock.Mock()
+        self.patch(jjb.subprocess, 'check_call', check_call)
+        self.assertEqual(set(), jjb.job_names())
+        self.assertEqual(hook, check_call.call_args_list[0][0][0])
+        self.assertEqual(['jenkins-jobs', 'test'],
+                         check_call.call_args_list[1][0][0][:2])
+
+
+class VirtualenvTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(VirtualenvTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        root = os.path.join(self.tmpdir, 'opt')
+        os.mkdir(root)
+        os.mkdir(os.path.join(self.tmpdir, 'bin'))
+        self.patch(jjb, 'VENV_ROOT', root)
+        self.patch(jjb, 'VENV_CURRENT', os.path.join(root, 'current'))
+        self.patch(jjb, 'VENV_PREVIOUS', os.path.join(root, 'previous'))
+        self.patch(jjb, 'VENV_BIN_DIR', os.path.join(self.tmpdir, 'bin'))
+        self.patch(jjb, 'log', mock.Mock())
+
+    def _venv(self, name):
+        path = os.path.join(jjb.VENV_ROOT, name)
+        os.makedirs(os.path.join(path, 'bin'))
+        return path
+
+    def test_activate_keeps_previous(self):
+        v1, v2, v3 = [self._venv('venv-%d' % i) for i in range(3)]
+        for venv in (v1, v2, v3):
+            jjb._activate_virtualenv(venv)
+        self.assertEqual(v3, os.path.realpath(jjb.VENV_CURRENT))
+        self.assertEqual(v2, os.path.realpath(jjb.VENV_PREVIOUS))
+        self.assertFalse(os.path.exists(v1))
+        self.assertEqual(
+            os.path.join(jjb.VENV_CURRENT, 'bin', 'jenkins-jobs'),
+            os.readlink(os.path.join(jjb.VENV_BIN_DIR, 'jenkins-jobs')))
+
+        jjb.rollback_virtualenv()
+        self.assertEqual(v2, os.path.realpath(jjb.VENV_CURRENT))
+        self.assertEqual(v3, os.path.realpath(jjb.VENV_PREVIOUS))
+
+    def test_deactivate_removes_links(self):
+        jjb._activate_virtualenv(self._venv('venv-1'))
+        link = os.path.join(jjb.VENV_BIN_DIR, 'jenkins-jobs')
+        self.assertTrue(os.path.islink(link))
+        jjb._deactivate_virtualenv()
+        self.assertFalse(os.path.lexists(link))
+
+    def test_rollback_without_previous(self):
+        self.assertRaises(Exception, jjb.rollback_virtualenv)
+
+    def test_install_from_git(self):
+        self.patch(jjb, 'config', {
+            'jjb-install-source': 'https://example.com/jjb.git',
+            'jjb-virtualenv': True}.get)
+        self.patch(jjb, 'CONFIG_DIR', self.tmpdir)
+        self.patch(jjb, 'charm_dir', mock.Mock(return_value=self.tmpdir))
+        self.patch(jjb, '_jjb_installed', mock.Mock(return_value=False))
+        self.patch(jjb, '_git_head', mock.Mock(return_value='abc'))
+        self.patch(jjb, 'State', mock.MagicMock())
+        self.patch(jjb, 'apt_install', mock.Mock())
+        self.patch(jjb, 'filter_installed_packages', lambda pkgs: pkgs)
+        self.patch(jjb, 'WHEELHOUSE', os.path.join(jjb.VENV_ROOT, 'wheel'))
+        check_call = mock.Mock(side_effect=self._build)
+        self.patch(jjb.subprocess, 'check_call', check_call)
+
+        jjb.install()
+        self.assertEqual(['pip', 'wheel', '--wheel-dir', jjb.WHEELHOUSE,
+                          '--find-links', jjb.WHEELHOUSE,
+                          'git+https://example.com/jjb.git'],
+                         check_call.call_args_list[0][0][0])
+        self.assertNotIn('tar', [call[0][0][0]
+                                 for call in check_call.call_args_list])
+        self.assertTrue(os.path.islink(jjb.VENV_CURRENT))
+
+    def _build(self, cmd, **kwargs):
+        if cmd[:2] == ['pip', 'wheel']:
+            open(os.path.join(jjb.WHEELHOUSE,
+                              'jenkins_job_builder-1.0-py2-none-any.whl'),
+                 'w').close()
+        elif cmd[0] == 'virtualenv':
+            os.makedirs(os.path.join(cmd[1], 'bin'))
+            open(os.path.join(cmd[1], 'bin', 'jenkins-jobs'), 'w').close()
+
+    def test_install_reuses_built_virtualenv(self):
+        fingerprint = ('git', 'https://example.com/jjb.git', 'abc')
+        check_call = mock.Mock(side_effect=self._build)
+        self.patch(jjb.subprocess, 'check_call', check_call)
+        self.patch(jjb, 'apt_install', mock.Mock())
+        self.patch(jjb, 'filter_installed_packages', lambda pkgs: pkgs)
+        self.patch(jjb, 'WHEELHOUSE', os.path.join(jjb.VENV_ROOT, 'wheel'))
+
+        jjb.install_virtualenv(fingerprint, repo=fingerprint[1])
+        venv = os.path.realpath(jjb.VENV_CURRENT)
+        self.assertEqual(4, check_call.call_count)
+        self.assertEqual([os.path.join(venv, 'bin', 'jenkins-jobs'),
+                          '--version'], check_call.call_args[0][0])
+
+        jjb._activate_virtualenv(self._venv('venv-other'))
+        jjb.install_virtualenv(fingerprint, repo=fingerprint[1])
+        self.assertEqual(4, check_call.call_count)
+        self.assertEqual(venv, os.path.realpath(jjb.VENV_CURRENT))
@@ -0,0 +1,278 @@
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import testtools
+
+from cihelpers import lpsync
+
+ALICE = ('alice', 'Alice', 'alice@example.com', ('ssh-rsa B', 'ssh-rsa A'),
+         'https://login.launchpad.net/+id/a')
+BOB = ('bob', 'Bob', 'bob@example.com', (), None)
+
+
+class FakePerson(object):
+
+    def __init__(self, name, members=(), email=None, keys=()):
+        self.name = name
+        self.is_team = bool(members)
+        self.display_name = name.capitalize()
+        self.preferred_email_address = mock.Mock(email=email)
+        self.sshkeys = [mock.Mock(keytype='RSA', keytext=key, comment='')
+                        for key in keys]
+        self.members_details = [
+            mock.Mock(self_link='https://api/~%s/+member/%s' % (name, member),
+                      status='Approved', http_etag='etag-%s' % member)
+            for member in members]
+
+
+class FakePeople(dict):
+
+    def __init__(self, *args):
+        super(FakePeople, self).__init__(*args)
+        self.fetched = []
+
+    def __getitem__(self, name):
+        self.fetched.append(name)
+        return super(FakePeople, self).__getitem__(name)
+
+
+class FakeLaunchpad(object):
+
+    def __init__(self, *people):
+        self.people = FakePeople((person.name, person) for person in people)
+
+
+class FakeGerritClient(object):
+
+    def __init__(self, failed=()):
+        self.calls = []
+        self.failed = failed
+
+    def create_group(self, group):
+        self.calls.append(('create_group', group))
+
+    def create_users_batch(self, group, users, flush=True):
+        self.calls.append(('create_users_batch', group,
+                           [user[0] for user in users]))
+        return True, [user[0] for user in users if user[0] in self.failed]
+
+    def remove_group_members(self, group, logins):
+        self.calls.append(('remove_group_members', group, logins))
+
+    def flush_cache(self, caches=None):
+        self.calls.append(('flush_cache',))
+
+
+class LPSyncTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(LPSyncTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.snapshot = os.path.join(self.tmpdir, lpsync.SNAPSHOT_FILE)
+
+    def test_diff_group_no_snapshot(self):
+        records, changed, removed = lpsync.diff_group({}, [ALICE, BOB])
+        self.assertEqual([ALICE, BOB], changed)
+        self.assertEqual([], removed)
+        self.assertEqual(['Alice', 'alice@example.com',
+                          ['ssh-rsa A', 'ssh-rsa B'],
+                          'https://login.launchpad.net/+id/a'],
+                         records['alice'])
+
+    def test_diff_group_changes(self):
+        previous, _, _ = lpsync.diff_group({}, [ALICE, BOB])
+        carol = ('carol', 'Carol', 'carol@example.com', (), None)
+        bob = ('bob', 'Bob', 'bob@example.com', ('ssh-rsa C',), None)
+        alice = ('alice', 'Alice', 'alice@example.com',
+                 ('ssh-rsa A', 'ssh-rsa B'),
+                 'https://login.launchpad.net/+id/a')
+        _, changed, removed = lpsync.diff_group(previous, [alice, bob, carol])
+        self.assertEqual([bob, carol], changed)
+        self.assertEqual([], removed)
+
+        _, changed, removed = lpsync.diff_group(previous, [alice])
+        self.assertEqual([], changed)
+        self.assertEqual(['bob'], removed)
+
+    def test_snapshot_roundtrip(self):
+        records, _, _ = lpsync.diff_group({}, [ALICE, BOB])
+        taken = time.time() - 60
+        lpsync.save_snapshot(self.snapshot, {'devs': records}, taken)
+        groups, loaded_taken = lpsync.load_snapshot(self.snapshot)
+        self.assertEqual(taken, loaded_taken)
+        _, changed, removed = lpsync.diff_group(groups['devs'], [ALICE, BOB])
+        self.assertEqual(([], []), (changed, removed))
+
+    def test_snapshot_expired(self):
+        lpsync.save_snapshot(self.snapshot, {'devs': {}},
+                             time.time() - lpsync.SNAPSHOT_MAX_AGE - 1)
+        groups, taken = lpsync.load_snapshot(self.snapshot)
+        self.assertEqual({}, groups)
+        self.assertTrue(time.time() - taken < 60)
+
+    def test_snapshot_missing_or_corrupt(self):
+        self.assertEqual({}, lpsync.load_snapshot(self.snapshot)[0])
+        with open(self.snapshot, 'w') as f:
+            f.write('{not json')
+        self.assertEqual({}, lpsync.load_snapshot(self.snapshot)[0])
+
+    def test_openid_cache_discovers_once(self):
+        path = os.path.join(self.tmpdir, lpsync.OPENID_CACHE_FILE)
+        discover = mock.Mock(side_effect=lambda login: 'https://id/%s' % login)
+        cache = lpsync.OpenIDCache(path, discover)
+        self.assertEqual('https://id/alice', cache.get('alice'))
+        self.assertEqual('https://id/alice', cache.get('alice'))
+        cache.close()
+
+        cache = lpsync.OpenIDCache(path, discover)
+        self.assertEqual('https://id/alice', cache.get('alice'))
+        cache.close()
+        discover.assert_called_once_with('alice')
+
+    def test_openid_cache_refreshes_expired_in_background(self):
+        path = os.path.join(self.tmpdir, lpsync.OPENID_CACHE_FILE)
+        lpsync.save_json(path, {'alice': ['https://old/alice', 0],
+                                'bob': ['https://old/bob', 0]})
+        discover = mock.Mock(side_effect=lambda login: 'https://id/%s' % login)
+        cache = lpsync.OpenIDCache(path, discover, max_refresh=1)
+        # expired entries are served stale while refreshed
+        self.assertEqual('https://old/alice', cache.get('alice'))
+        self.assertEqual('https://old/bob', cache.get('bob'))
+        cache.close()
+        discover.assert_called_once_with('alice')
+        entries = lpsync.load_json(path)
+        self.assertEqual('https://id/alice', entries['alice'][0])
+        self.assertEqual('https://old/bob', entries['bob'][0])
+
+    def test_member_cache(self):
+        path = os.path.join(self.tmpdir, lpsync.MEMBER_CACHE_FILE)
+        cache = lpsync.MemberCache(path)
+        self.assertIsNone(cache.get('alice', 'etag-1'))
+        cache.set('alice', 'etag-1', 'U', ALICE)
+        cache.set('team', 'etag-2', 'T', 'team')
+        cache.close()
+
+        cache = lpsync.MemberCache(path)
+        self.assertEqual(('U', ALICE), cache.get('alice', 'etag-1'))
+        cache.close()
+
+        cache = lpsync.MemberCache(path)
+        # membership changed
+        self.assertIsNone(cache.get('alice', 'etag-3'))
+        # only entries used in the last run are kept
+        self.assertIsNone(cache.get('team', 'etag-2'))
+
+    def test_member_cache_expiry(self):
+        path = os.path.join(self.tmpdir, lpsync.MEMBER_CACHE_FILE)
+        cache = lpsync.MemberCache(path, max_age=100)
+        cache.set('alice', 'etag-1', 'U', ALICE)
+        with mock.patch('time.time', return_value=time.time() + 49):
+            self.assertEqual(('U', ALICE), cache.get('alice', 'etag-1'))
+        with mock.patch('time.time', return_value=time.time() + 101):
+            self.assertIsNone(cache.get('alice', 'etag-1'))
+
+
+class SyncGroupsTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(SyncGroupsTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.snapshot = os.path.join(self.tmpdir, lpsync.SNAPSHOT_FILE)
+        self.patch(lpsync, 'log', mock.Mock())
+        self.launchpad = FakeLaunchpad(
+            FakePerson('devs', members=['alice', 'core']),
+            FakePerson('core', members=['bob']),
+            FakePerson('alice', email='alice@example.com', keys=['A']),
+            FakePerson('bob', email='bob@example.com'),
+            FakePerson('nomail'))
+
+    def _sync(self, groups, failed=(), **kwargs):
+        reader = lpsync.LaunchpadReader(
+            lambda: self.launchpad,
+            lpsync.OpenIDCache(os.path.join(self.tmpdir, 'openids.json'),
+                               lambda login: None),
+            lpsync.MemberCache(os.path.join(self.tmpdir, 'members.json')),
+            workers=2)
+        gerrit = FakeGerritClient(failed)
+        try:
+            result = lpsync.sync_groups(groups, reader, gerrit,
+                                        self.snapshot, **kwargs)
+        finally:
+            reader.close()
+        return result, gerrit.calls
+
+    def test_group_users_recurses_sub_teams(self):
+        reader = lpsync.LaunchpadReader(
+            lambda: self.launchpad,
+            lpsync.OpenIDCache(os.path.join(self.tmpdir, 'openids.json'),
+                               lambda login: None),
+            lpsync.MemberCache(os.path.join(self.tmpdir, 'members.json')))
+        self.addCleanup(reader.close)
+        self.assertEqual(
+            [('alice', 'Alice', 'alice@example.com', ('ssh-rsa A',), None),
+             ('bob', 'Bob', 'bob@example.com', (), None)],
+            list(reader.group_users(['devs'])))
+
+    def test_sync_groups_streams_changes(self):
+        self.launchpad.people['devs'].members_details.append(mock.Mock(
+            self_link='https://api/~devs/+member/nomail', status='Approved',
+            http_etag='etag-nomail'))
+        result, calls = self._sync({'devs': 'devs'}, queue_size=1)
+        self.assertEqual((2, 0), result)
+        self.assertEqual([('create_group', 'devs'),
+                          ('create_users_batch', 'devs', ['alice', 'bob']),
+                          ('flush_cache',)], calls)
+
+        # unchanged users are not pushed again, removed ones are
+        del self.launchpad.people['core'].members_details[:]
+        result, calls = self._sync({'devs': 'devs'})
+        self.assertEqual((0, 1), result)
+        self.assertEqual([('create_group', 'devs'),
+                          ('remove_group_members', 'devs', ['bob'])], calls)
+
+    def test_sync_groups_retries_failed_users(self):
+        result, calls = self._sync({'devs': 'devs'}, failed=['alice'])
+        self.assertEqual((1, 0), result)
+        # alice is neither taken as applied nor as removed
+        result, calls = self._sync({'devs': 'devs'}, failed=['alice'])
+        self.assertEqual((0, 0), result)
+        self.assertIn(('create_users_batch', 'devs', ['alice']), calls)
+        self.assertNotIn('remove_group_members', [call[0] for call in calls])
+        result, calls = self._sync({'devs': 'devs'})
+        self.assertEqual((1, 0), result)
+        result, calls = self._sync({'devs': 'devs'})
+        self.assertEqual((0, 0), result)
+
+    def test_sync_groups_shared_teams(self):
+        self.launchpad.people['ops'] = FakePerson('ops',
+                                                  members=['core', 'bob'])
+        result, calls = self._sync({'devs': 'devs', 'ops': 'ops core'})
+        self.assertEqual(
+            [('create_users_batch', 'devs', ['alice', 'bob']),
+             ('create_users_batch', 'ops', ['bob'])],
+            sorted(call for call in calls
+                   if call[0] == 'create_users_batch'))
+        # sub-teams are looked up once as a member and once for their members
+        fetched = self.launchpad.people.fetched
+        self.assertEqual({'devs': 1, 'ops': 1, 'core': 2, 'alice': 1,
+                          'bob': 1},
+                         dict((name, fetched.count(name))
+                              for name in set(fetched)))
+
+    def test_sync_groups_batches(self):
+        self.patch(lpsync, 'GSQL_BATCH_SIZE', 1)
+        result, calls = self._sync({'devs': 'devs'})
+        self.assertEqual([('create_users_batch', 'devs', ['alice']),
+                          ('create_users_batch', 'devs', ['bob'])],
+                         [call for call in calls
+                          if call[0] == 'create_users_batch'])
+
+    def test_sync_groups_reader_error(self):
+        del self.launchpad.people['core']
+        self.assertRaises(KeyError, self._sync, {'devs': 'devs'})
+        self.assertFalse(os.path.exists(self.snapshot))
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+
+import testtools
+
+from cihelpers import metrics
+
+
+class MetricsTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(metrics, '_pending', {})
+        self.patch(metrics, 'BUCKETS', (1, 10))
+
+    def _textfile(self):
+        with open(os.path.join(self.tmpdir, metrics.TEXTFILE)) as f:
+            return f.read().splitlines()
+
+    def test_flush_accumulates_runs(self):
+        metrics.inc('ci_configurator_restarts_total', service='zuul')
+        metrics.observe('ci_configurator_hook_duration_seconds', 5,
+                        hook='install')
+        metrics.flush(self.tmpdir)
+        metrics.inc('ci_configurator_restarts_total', service='zuul')
+        metrics.observe('ci_configurator_hook_duration_seconds', 0.5,
+                        hook='install')
+        metrics.flush(self.tmpdir)
+
+        lines = self._textfile()
+        self.assertIn('# TYPE ci_configurator_hook_duration_seconds '
+                      'histogram', lines)
+        self.assertIn('ci_configurator_hook_duration_seconds_bucket'
+                      '{hook="install",le="1"} 1', lines)
+        self.assertIn('ci_configurator_hook_duration_seconds_bucket'
+                      '{hook="install",le="10"} 2', lines)
+        self.assertIn('ci_configurator_hook_duration_seconds_bucket'
+                      '{hook="install",le="+Inf"} 2', lines)
+        self.assertIn('ci_configurator_hook_duration_seconds_sum'
+                      '{hook="install"} 5.5', lines)
+        self.assertIn('ci_configurator_restarts_total{service="zuul"} 2',
+                      lines)
+        with open(os.path.join(self.tmpdir, metrics.STATE_FILE)) as f:
+            self.assertEqual(
+                {'service="zuul"': 2},
+                json.load(f)['ci_configurator_restarts_total'])
+
+    def test_flush_without_textfile_dir(self):
+        metrics.inc('ci_configurator_restarts_total', service='zuul')
+        metrics.flush(os.path.join(self.tmpdir, 'missing'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     'missing')))
@@ -0,0 +1,50 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import testtools
+
+from cihelpers import profiling
+
+
+class ProfilerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.profiler = profiling.Profiler()
+
+    def test_disabled(self):
+        check_output = subprocess.check_output
+        self.profiler.start('')
+        with self.profiler.span('phase'):
+            pass
+        self.assertEqual([], self.profiler.spans)
+        self.assertIs(check_output, subprocess.check_output)
+
+    def test_report(self):
+        check_output = subprocess.check_output
+
+        @self.profiler.timed
+        def update_zuul():
+            subprocess.check_output(['true'])
+
+        self.profiler.start(profiling.CPROFILE)
+        with self.profiler.span('hook config-changed'):
+            update_zuul()
+        self.profiler.stop(self.tmpdir, 'config-changed')
+
+        self.assertIs(check_output, subprocess.check_output)
+        self.assertEqual(['hook config-changed', 'update_zuul',
+                          'subprocess: true'],
+                         [span for _, _, _, span in sorted(
+                             self.profiler.spans,
+                             key=lambda span: (span[0], span[2]))])
+        with open(os.path.join(self.tmpdir, 'config-changed.txt')) as f:
+            report = f.read().splitlines()
+        self.assertEqual(5, len(report))
+        self.assertTrue(report[4].endswith('      subprocess: true'))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'config-changed.prof')))
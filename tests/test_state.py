@@ -0,0 +1,29 @@
+import testtools
+
+from cihelpers import state
+from helpers import use_temp_unitdata
+
+
+class StateTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(StateTestCase, self).setUp()
+        use_temp_unitdata(self)
+
+    def test_needs_work(self):
+        jjb = state.State('jjb')
+        self.assertTrue(jjb.needs_work('distro'))
+        jjb.done('distro', version='1.6')
+
+        jjb = state.State('jjb')
+        self.assertFalse(jjb.needs_work('distro'))
+        self.assertTrue(jjb.needs_work('git://example.com/jjb.git'))
+        self.assertEqual({'version': '1.6'}, jjb.info)
+        self.assertIsNotNone(jjb.last_success)
+        self.assertTrue(state.State('zuul').needs_work('distro'))
+
+    def test_reset(self):
+        jjb = state.State('jjb')
+        jjb.done('distro')
+        jjb.reset()
+        self.assertTrue(state.State('jjb').needs_work('distro'))
@@ -0,0 +1,241 @@
+import datetime
+import os
+import shutil
+import signal
+import tempfile
+
+import mock
+import testtools
+import yaml
+
+import jjb
+import zuul
+from helpers import use_temp_unitdata
+
+LAYOUT = """
+pipelines:
+  - name: check
+    manager: IndependentPipelineManager
+  - name: gate
+    manager: DependentPipelineManager
+project-templates:
+  - name: python-jobs
+    check:
+      - '{name}-pep8'
+projects:
+  - name: org/proj
+    template:
+      - name: python-jobs
+    gate:
+      - proj-unit:
+        - proj-docs
+"""
+
+
+class ZuulTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(ZuulTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.config_dir = os.path.join(self.tmpdir, 'zuul')
+        os.mkdir(self.config_dir)
+        self.layout = os.path.join(self.tmpdir, 'layout.yaml')
+        self.pid_file = os.path.join(self.tmpdir, 'zuul.pid')
+        self.patch(zuul, 'ZUUL_CONFIG_DIR', self.config_dir)
+        self.patch(zuul, 'ZUUL_LAYOUT', self.layout)
+        self.patch(zuul, 'ZUUL_PID_FILE', self.pid_file)
+        self.patch(zuul, 'ZUUL_FRAGMENTS_DIR',
+                   os.path.join(self.config_dir, 'layout.d'))
+        self.patch(zuul, 'ZUUL_ASSEMBLED_LAYOUT',
+                   os.path.join(self.tmpdir, 'assembled.yaml'))
+        self.patch(zuul, 'charm_dir', mock.Mock(return_value=self.tmpdir))
+        self.patch(zuul, 'log', mock.Mock())
+        self.patch(zuul, 'relation_ids', mock.Mock(return_value=['zuul:1']))
+        self.patch(zuul, 'related_units', mock.Mock(return_value=['zuul/0']))
+        self.patch(zuul, 'stop_zuul', mock.Mock())
+        self.patch(zuul, 'start_zuul', mock.Mock())
+        self.kill = mock.Mock()
+        self.patch(zuul.os, 'kill', self.kill)
+        self.patch(zuul, 'validate_layout_cached', mock.Mock(return_value=[]))
+
+    def _write_layout(self, content):
+        with open(os.path.join(self.config_dir, 'layout.yaml'), 'w') as f:
+            f.write(content)
+
+    def test_update_zuul_reloads_changed_layout(self):
+        with open(self.pid_file, 'w') as f:
+            f.write('1234\n')
+        self._write_layout('pipelines: []\n')
+        self.assertTrue(zuul.update_zuul())
+        with open(self.layout) as f:
+            self.assertEqual('pipelines: []\n', f.read())
+        self.kill.assert_called_once_with(1234, signal.SIGHUP)
+        self.assertFalse(zuul.stop_zuul.called)
+
+        # unchanged layout, nothing to do
+        self.kill.reset_mock()
+        self.assertTrue(zuul.update_zuul())
+        self.assertFalse(self.kill.called)
+
+    def test_update_zuul_restarts_if_reload_fails(self):
+        self._write_layout('pipelines: []\n')
+        self.assertTrue(zuul.update_zuul())
+        self.assertFalse(self.kill.called)
+        zuul.stop_zuul.assert_called_once_with()
+        zuul.start_zuul.assert_called_once_with()
+
+    def test_update_zuul_invalid_layout_not_installed(self):
+        self._write_layout('pipelines: []\n')
+        zuul.validate_layout_cached.return_value = ['no pipelines defined']
+        self.assertFalse(zuul.update_zuul())
+        self.assertFalse(os.path.exists(self.layout))
+        self.assertFalse(zuul.stop_zuul.called)
+
+    def test_update_zuul_installs_assembled_layout(self):
+        self._write_layout(LAYOUT)
+        os.mkdir(zuul.ZUUL_FRAGMENTS_DIR)
+        with open(os.path.join(zuul.ZUUL_FRAGMENTS_DIR, 'other.yaml'),
+                  'w') as f:
+            f.write('projects:\n  - name: org/other\n    check: [lint]\n')
+        self.assertTrue(zuul.update_zuul())
+        with open(self.layout) as f:
+            layout = yaml.safe_load(f)
+        self.assertEqual(['org/proj', 'org/other'],
+                         [project['name'] for project in layout['projects']])
+        zuul.validate_layout_cached.assert_called_once_with(
+            zuul.ZUUL_ASSEMBLED_LAYOUT)
+
+
+class AssembleLayoutTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(AssembleLayoutTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.base = os.path.join(self.tmpdir, 'layout.yaml')
+        self.fragments = os.path.join(self.tmpdir, 'layout.d')
+        self.cache = os.path.join(self.tmpdir, 'fragments.pickle')
+        os.mkdir(self.fragments)
+        with open(self.base, 'w') as f:
+            f.write(LAYOUT)
+
+    def _fragment(self, name, content):
+        with open(os.path.join(self.fragments, name), 'w') as f:
+            f.write(content)
+
+    def _assemble(self):
+        return zuul.assemble_layout(self.base, self.fragments, self.cache)
+
+    def test_merge(self):
+        self._fragment('b.yaml', 'projects:\n  - name: org/b\n')
+        self._fragment('a.yaml', 'projects:\n  - name: org/a\n')
+        self._fragment('README', 'not a fragment')
+        layout, errors = self._assemble()
+        self.assertEqual([], errors)
+        self.assertEqual(['org/proj', 'org/a', 'org/b'],
+                         [project['name'] for project in layout['projects']])
+        self.assertEqual(2, len(layout['pipelines']))
+
+    def test_duplicates(self):
+        self._fragment('a.yaml', 'projects:\n  - name: org/proj\n')
+        layout, errors = self._assemble()
+        self.assertEqual(['layout.d/a.yaml: projects org/proj already '
+                          'defined in layout.yaml'], errors)
+
+    def test_only_changed_fragments_parsed(self):
+        self._fragment('a.yaml', 'projects:\n  - name: org/a\n')
+        self._fragment('b.yaml', 'projects:\n  - name: org/b\n')
+        self._assemble()
+        self._fragment('b.yaml', 'projects:\n  - name: org/c\n')
+        safe_load = mock.Mock(side_effect=yaml.safe_load)
+        self.patch(zuul.yaml, 'safe_load', safe_load)
+        layout, errors = self._assemble()
+        self.assertEqual(1, safe_load.call_count)
+        self.assertEqual(['org/proj', 'org/a', 'org/c'],
+                         [project['name'] for project in layout['projects']])
+
+    def test_cached_fragments_keep_yaml_types(self):
+        self._fragment('a.yaml', 'projects:\n  - name: org/a\n'
+                                 '    1: one\n    since: 2016-01-01\n')
+        first, errors = self._assemble()
+        self.assertEqual([], errors)
+        self.assertEqual(0o600, os.stat(self.cache).st_mode & 0o777)
+        second, errors = self._assemble()
+        self.assertEqual([], errors)
+        self.assertEqual(first, second)
+        self.assertEqual('one', second['projects'][1][1])
+        self.assertEqual(datetime.date(2016, 1, 1),
+                         second['projects'][1]['since'])
+        self.assertFalse(os.path.exists(self.cache + '.tmp'))
+
+
+class ValidateLayoutTestCase(testtools.TestCase):
+
+    def test_valid(self):
+        layout = yaml.safe_load(LAYOUT)
+        self.assertEqual([], zuul.validate_layout(layout))
+        self.assertEqual([], zuul.validate_layout(
+            layout, set(['proj-pep8', 'proj-unit', 'proj-docs'])))
+
+    def test_unknown_references(self):
+        layout = yaml.safe_load(LAYOUT)
+        layout['projects'][0]['post'] = ['proj-publish']
+        layout['projects'].append({'name': 'org/other',
+                                   'template': [{'name': 'missing'}]})
+        self.assertEqual(
+            ['project org/proj: pipeline check: unknown job proj-pep8',
+             'project org/proj: pipeline gate: unknown job proj-docs',
+             'project org/proj: unknown pipeline post',
+             'project org/other: unknown template missing'],
+            sorted(zuul.validate_layout(layout, set(['proj-unit'])),
+                   key=lambda error: 'org/other' in error))
+
+    def test_builtin_jobs(self):
+        layout = yaml.safe_load(LAYOUT)
+        layout['projects'][0]['check'] = ['noop']
+        self.assertEqual([], zuul.validate_layout(
+            layout, set(['proj-pep8', 'proj-unit', 'proj-docs'])))
+
+    def test_malformed(self):
+        self.assertEqual(['layout is not a mapping'],
+                         zuul.validate_layout(['pipelines']))
+        self.assertEqual(['no pipelines defined'], zuul.validate_layout({}))
+        self.assertEqual(['pipelines: duplicate check'],
+                         zuul.validate_layout(yaml.safe_load(
+                             'pipelines: [{name: check, manager: m}, '
+                             '{name: check, manager: m}]')))
+
+    def test_validate_layout_cached(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        layout_path = os.path.join(tmpdir, 'layout.yaml')
+        with open(layout_path, 'w') as f:
+            f.write(LAYOUT)
+        use_temp_unitdata(self)
+        self.patch(zuul, 'log', mock.Mock())
+        jobs_dir = os.path.join(tmpdir, 'jobs')
+        os.mkdir(jobs_dir)
+        self.patch(jjb, 'JOBS_CONFIG_DIR', jobs_dir)
+        job_names = mock.Mock(return_value=set(['proj-unit']))
+        self.patch(jjb, 'job_names', job_names)
+        self.patch(jjb, '_jjb_installed', mock.Mock(return_value=True))
+
+        errors = zuul.validate_layout_cached(layout_path)
+        self.assertEqual(2, len(errors))
+        self.assertEqual(errors, zuul.validate_layout_cached(layout_path))
+        self.assertEqual(1, job_names.call_count)
+
+        with open(layout_path, 'a') as f:
+            f.write('\n')
+        zuul.validate_layout_cached(layout_path)
+        self.assertEqual(2, job_names.call_count)
+
+        # without jenkins-job-builder job names are not checked, and that
+        # result is not reused once it is installed
+        jjb._jjb_installed.return_value = False
+        self.assertEqual([], zuul.validate_layout_cached(layout_path))
+        self.assertEqual(2, job_names.call_count)
+        jjb._jjb_installed.return_value = True
+        self.assertEqual(errors, zuul.validate_layout_cached(layout_path))
+        self.assertEqual(2, job_names.call_count)